@@ -0,0 +1,62 @@
+"""Serialization benchmark for the hot response payloads.
+
+Compares the stock FastAPI/Starlette JSON path (before) with the negotiated encoders and the
+precomputed payloads (after), using test_analyze.json as the analysis fixture. Each "after" row
+is shown against the first "before" row of its section; for AnalysisResponse that is
+model_dump_json, which is what a response_model route ran before the change.
+
+    python bench_serialization.py [iterations]
+"""
+import json
+import sys
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from main import AnalysisResponse, EncodedPayload, ENCODERS, get_catalog
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+def starlette_json(content) -> bytes:
+    # What JSONResponse.render does for a route without a response model
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def bench(label: str, fn, baseline: float = 0.0) -> float:
+    fn()  # Warm-up
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        body = fn()
+    elapsed = (time.perf_counter() - start) / ITERATIONS * 1e6
+    ratio = f"   {baseline / elapsed:6.1f}x vs before" if baseline else ""
+    print(f"  {label:<48} {elapsed:9.1f} µs   {len(body):7d} bytes{ratio}")
+    return elapsed
+
+def main():
+    with open("test_analyze.json", encoding="utf-8") as f:
+        analysis = AnalysisResponse(**json.load(f))
+    history = [{"barcode": f"84100000{i:05d}", "name": analysis.product_name, "status": analysis.status,
+                "score": analysis.score, "date": "2026-10-19T12:00:00.000000"} for i in range(20)]
+    catalog = get_catalog()
+    detail = catalog.details[0]
+
+    print(f"AnalysisResponse ({ITERATIONS} iterations)")
+    before = bench("before: model_dump_json (response_model route)", lambda: analysis.model_dump_json().encode())
+    bench("after: build payload, json (cache miss)", lambda: EncodedPayload.from_model(analysis).encode("json"), before)
+    bench("after: build payload, msgpack (cache miss)", lambda: EncodedPayload.from_model(analysis).encode("msgpack"), before)
+    payload = EncodedPayload.from_model(analysis)
+    bench("after: precomputed json (cache hit)", lambda: payload.encode("json"), before)
+    bench("after: precomputed msgpack (cache hit)", lambda: payload.encode("msgpack"), before)
+    bench("reference: jsonable_encoder + json.dumps (no model)", lambda: starlette_json(jsonable_encoder(analysis)))
+
+    print("History (20 rows)")
+    before = bench("before: json.dumps", lambda: starlette_json(history))
+    bench("after: orjson", lambda: ENCODERS["json"][1](history), before)
+    bench("after: msgpack", lambda: ENCODERS["msgpack"][1](history), before)
+
+    print("Additive detail")
+    before = bench("before: json.dumps", lambda: starlette_json(detail))
+    bench("after: precomputed json", lambda: catalog.payload(detail).encode("json"), before)
+    bench("after: precomputed msgpack", lambda: catalog.payload(detail).encode("msgpack"), before)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
-from fastapi import FastAPI, HTTPException, Depends, status
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Depends, status, Request, WebSocket, WebSocketDisconnect, Header
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 import httpx
 import os
@@ -9,14 +10,28 @@ import sqlite3
 import json
 import re
 import asyncio
-from datetime import datetime
-from typing import List, Optional, Dict
+import time
+import hashlib
+import threading
+import bisect
+import heapq
+import itertools
+import uuid
+import secrets
+import unicodedata
+import sys
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Tuple
 from passlib.context import CryptContext
 import google.generativeai as genai
 import base64
 import traceback
 from supabase import create_client, Client
 from dotenv import load_dotenv
+import numpy as np
+import orjson
+import msgpack
 
 load_dotenv()
 
@@ -38,6 +53,116 @@ if SUPABASE_URL and SUPABASE_KEY:
 else:
     print("DB: Using local SQLite database")
 
+# Admission Control (per-route budgets, priority classes and load shedding)
+# Each class has a concurrency budget and a bounded wait queue; requests that cannot get a
+# slot in time are rejected fast with 503 + Retry-After. Lower-priority classes also stop
+# admitting once the worker as a whole is busy, so scans keep capacity when AI calls pile up.
+ADMISSION_GLOBAL_LIMIT = int(os.getenv("ADMISSION_GLOBAL_LIMIT", 64))
+
+class AdmissionClass:
+    def __init__(self, name: str, priority: int, concurrency: int, queue_limit: int, max_wait: float, global_share: float):
+        self.name = name
+        self.priority = priority
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.max_wait = max_wait
+        self.global_share = global_share  # Fraction of ADMISSION_GLOBAL_LIMIT this class may fill
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "priority": self.priority, "inflight": self.inflight, "waiting": self.waiting,
+            "concurrency": self.concurrency, "queue_limit": self.queue_limit,
+            "admitted": self.admitted, "shed": self.shed
+        }
+
+class AdmissionController:
+    def __init__(self, classes: List[AdmissionClass], routes: List[tuple], exempt: tuple, default: str):
+        self.classes = {c.name: c for c in classes}
+        self.routes = routes    # (path prefix, class name), first match wins
+        self.exempt = exempt    # Path prefixes never throttled
+        self.default = default
+
+    def classify(self, path: str) -> Optional[AdmissionClass]:
+        if path == "/" or path.startswith(self.exempt): return None
+        for prefix, name in self.routes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return self.classes[name]
+        return self.classes[self.default]
+
+    def total_inflight(self) -> int:
+        return sum(c.inflight for c in self.classes.values())
+
+    async def acquire(self, cls: AdmissionClass) -> bool:
+        if self.total_inflight() >= ADMISSION_GLOBAL_LIMIT * cls.global_share:
+            cls.shed += 1
+            return False
+        if cls.semaphore.locked():
+            if cls.waiting >= cls.queue_limit:
+                cls.shed += 1
+                return False
+            cls.waiting += 1
+            try:
+                await asyncio.wait_for(cls.semaphore.acquire(), timeout=cls.max_wait)
+            except asyncio.TimeoutError:
+                cls.shed += 1
+                return False
+            finally:
+                cls.waiting -= 1
+        else:
+            await cls.semaphore.acquire()
+        cls.inflight += 1
+        cls.admitted += 1
+        return True
+
+    def release(self, cls: AdmissionClass):
+        cls.inflight -= 1
+        cls.semaphore.release()
+
+    def snapshot(self) -> dict:
+        return {"global_limit": ADMISSION_GLOBAL_LIMIT, "inflight": self.total_inflight(),
+                "classes": {name: c.snapshot() for name, c in self.classes.items()}}
+
+admission = AdmissionController(
+    classes=[
+        AdmissionClass("scan", 0, int(os.getenv("ADMISSION_SCAN_CONCURRENCY", 32)), 64, 5.0, 1.0),
+        # Alternatives fan out to several slow OFF searches; keep them off the scan budget
+        AdmissionClass("alternatives", 1, int(os.getenv("ADMISSION_ALTERNATIVES_CONCURRENCY", 8)), 16, 3.0, 0.8),
+        AdmissionClass("data", 2, int(os.getenv("ADMISSION_DATA_CONCURRENCY", 16)), 32, 3.0, 0.8),
+        AdmissionClass("ai", 3, int(os.getenv("ADMISSION_AI_CONCURRENCY", 4)), 8, 2.0, 0.5),
+    ],
+    routes=[
+        ("/analyze", "scan"), ("/alternatives", "alternatives"), ("/ping", "scan"),
+        ("/lookup-additive", "scan"), ("/additives", "scan"),
+        ("/history", "data"), ("/stats", "data"), ("/ia-history-items", "data"),
+        ("/login", "data"), ("/register", "data"), ("/save-settings", "data"), ("/daily-tip", "data"),
+        ("/analyze-ingredients-image", "ai"), ("/generate-recipes", "ai"),
+    ],
+    # Job polling just sleeps and the job queue bounds itself; ops endpoints must stay reachable
+    exempt=("/static", "/jobs", "/metrics", "/docs", "/redoc", "/openapi.json"),
+    default="data",
+)
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    cls = admission.classify(request.url.path)
+    if cls is None:
+        return await call_next(request)
+    if not await admission.acquire(cls):
+        print(f"WARNING Admission: Shedding {request.url.path} ({cls.name}: {cls.inflight} in flight, {cls.waiting} waiting)")
+        return JSONResponse(
+            status_code=503, content={"detail": "Servidor ocupado, inténtalo de nuevo en unos segundos"},
+            headers={"Retry-After": str(1 + cls.priority * 2)}
+        )
+    try:
+        return await call_next(request)
+    finally:
+        admission.release(cls)
+
 @app.get("/", response_class=HTMLResponse)
 async def read_index():
     return FileResponse('static/index.html')
@@ -66,9 +191,11 @@ def db_update_last_active(username: str):
         conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
         cursor.execute("UPDATE users SET last_active=? WHERE username=?", (now, username))
         conn.commit(); conn.close()
+    db_rollup_touch_user(username, now)
 
-def db_save_history(username: str, barcode: str, product_name: str, status: str, score: int):
+def db_save_history(username: str, barcode: str, product_name: str, status: str, score: int, additives=()):
     now = datetime.now().isoformat()
+    items = rollup_scan_items(now, barcode, status, additives)
     if supabase:
         supabase.table("history").insert({
             "username": username, "barcode": barcode, 
@@ -76,12 +203,18 @@ def db_save_history(username: str, barcode: str, product_name: str, status: str,
             "score": score, "timestamp": now
         }).execute()
         supabase.table("users").update({"last_active": now}).eq("username", username).execute()
+        try:
+            supabase.rpc("rollup_add", {"items": [dict(zip(ROLLUP_COLUMNS, i)) for i in items]}).execute()
+        except Exception as e:
+            print(f"WARNING Rollups: Could not record scan: {str(e)}")
     else:
         conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
         cursor.execute("INSERT INTO history (username, barcode, product_name, status, score, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
                        (username, barcode, product_name, status, score, now))
         cursor.execute("UPDATE users SET last_active=? WHERE username=?", (now, username))
+        cursor.executemany(ROLLUP_UPSERT_SQL, items)
         conn.commit(); conn.close()
+    db_rollup_touch_user(username, now)
 
 def db_get_history(username: str, limit=50):
     if supabase:
@@ -94,6 +227,103 @@ def db_get_history(username: str, limit=50):
         conn.close()
         return [{"barcode": r[0], "name": r[1], "status": r[2], "score": r[3], "timestamp": r[4]} for r in rows]
 
+# Analytics Rollups
+# Global counters in hourly, daily and all-time buckets, incremented in the same write that records
+# a scan, so analytics never read raw history. Buckets are ISO timestamp prefixes ("2026-10-19T14",
+# "2026-10-19", "all"). Active users are counted once per bucket through the rollup_active_users set.
+ROLLUP_GRANULARITIES = (("hour", 13), ("day", 10), ("all", 0))
+ROLLUP_COLUMNS = ("granularity", "bucket", "metric", "dim", "n")
+ROLLUP_STATE_KEY = "rollups"  # Cloud only: app_state row holding the last history id that predates the rollups
+ROLLUP_UPSERT_SQL = ("INSERT INTO rollups (granularity, bucket, metric, dim, n) VALUES (?, ?, ?, ?, ?) "
+                     "ON CONFLICT(granularity, bucket, metric, dim) DO UPDATE SET n = n + excluded.n")
+
+def rollup_buckets(timestamp: str):
+    return [(g, timestamp[:size] if size else "all") for g, size in ROLLUP_GRANULARITIES]
+
+def rollup_scan_items(timestamp: str, barcode: str, status: str, additives=()):
+    items = []
+    for granularity, bucket in rollup_buckets(timestamp):
+        items.append((granularity, bucket, "scans", "", 1))
+        items.append((granularity, bucket, "status", status or "", 1))
+        if barcode: items.append((granularity, bucket, "barcode", barcode, 1))
+        items.extend((granularity, bucket, "additive", code, 1) for code in additives)
+    return items
+
+def rollup_status_items(timestamp: str, old_status: str, status: str):
+    """Moves a re-scored row between status counts. Pruned hourly buckets are left alone."""
+    if not timestamp or old_status == status: return []
+    hour_cutoff = (datetime.now() - timedelta(days=ROLLUP_HOURLY_RETENTION_DAYS)).isoformat()[:13]
+    items = []
+    for granularity, bucket in rollup_buckets(timestamp):
+        if granularity == "hour" and bucket < hour_cutoff: continue
+        items.append((granularity, bucket, "status", old_status or "", -1))
+        items.append((granularity, bucket, "status", status or "", 1))
+    return items
+
+def db_rollup_touch_user(username: str, timestamp: str):
+    """Count the user as active in the current buckets (at most one write per user and hour)."""
+    if not username: return
+    try:
+        if not shared_cache.add(f"rollup:seen:{timestamp[:13]}:{username}", 1, 3900): return
+        buckets = rollup_buckets(timestamp)
+        if supabase:
+            supabase.rpc("rollup_touch_user", {"p_username": username, "p_buckets": [{"granularity": g, "bucket": b} for g, b in buckets]}).execute()
+        else:
+            conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+            for granularity, bucket in buckets:
+                cursor.execute("INSERT OR IGNORE INTO rollup_active_users (granularity, bucket, username) VALUES (?, ?, ?)", (granularity, bucket, username))
+                if cursor.rowcount:
+                    cursor.execute(ROLLUP_UPSERT_SQL, (granularity, bucket, "active_users", "", 1))
+            conn.commit(); conn.close()
+    except Exception as e:
+        print(f"WARNING Rollups: Could not record activity: {str(e)}")
+
+ROLLUP_BACKFILL_CHUNK = int(os.getenv("ROLLUP_BACKFILL_CHUNK", 20000))
+
+def _rollup_meta(cursor, metric: str) -> int:
+    cursor.execute("SELECT n FROM rollups WHERE granularity='meta' AND bucket='' AND metric=? AND dim=''", (metric,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def db_backfill_rollups_chunk() -> Tuple[int, int]:
+    """Folds the next chunk of the history that predates the rollups into them and returns
+    (backfilled up to id, bound). init_db pins the bound; newer rows are counted live."""
+    if supabase:
+        return 0, 0  # Cloud rollups count from their creation on
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS new_users (granularity TEXT, bucket TEXT, username TEXT, PRIMARY KEY (granularity, bucket, username))")
+        cursor.execute("BEGIN IMMEDIATE")
+        bound, done = _rollup_meta(cursor, "backfill_until"), _rollup_meta(cursor, "backfill_done")
+        if done >= bound:
+            cursor.execute("COMMIT"); return done, bound
+        upto = min(done + ROLLUP_BACKFILL_CHUNK, bound)
+        rows = "FROM history WHERE id > ? AND id <= ? AND timestamp IS NOT NULL"
+        for granularity, size in ROLLUP_GRANULARITIES:
+            bucket = f"substr(timestamp, 1, {size})" if size else "'all'"
+            for metric, dim in (("scans", "''"), ("status", "COALESCE(status, '')"), ("barcode", "barcode")):
+                cursor.execute(f"INSERT INTO rollups (granularity, bucket, metric, dim, n) SELECT ?, {bucket}, ?, {dim}, COUNT(*) {rows} "
+                               f"AND {dim} IS NOT NULL GROUP BY 2, 4 ON CONFLICT(granularity, bucket, metric, dim) DO UPDATE SET n = n + excluded.n",
+                               (granularity, metric, done, upto))
+            # Only users not already counted in the bucket (by live scans or earlier chunks)
+            cursor.execute("DELETE FROM new_users")
+            cursor.execute(f"INSERT OR IGNORE INTO new_users SELECT ?, {bucket}, username {rows} AND username IS NOT NULL "
+                           f"AND NOT EXISTS (SELECT 1 FROM rollup_active_users a WHERE a.granularity=? AND a.bucket={bucket} AND a.username=history.username)",
+                           (granularity, done, upto, granularity))
+            cursor.execute("INSERT INTO rollups (granularity, bucket, metric, dim, n) SELECT granularity, bucket, 'active_users', '', COUNT(*) "
+                           "FROM new_users WHERE 1 GROUP BY 1, 2 ON CONFLICT(granularity, bucket, metric, dim) DO UPDATE SET n = n + excluded.n")
+            cursor.execute("INSERT OR IGNORE INTO rollup_active_users SELECT granularity, bucket, username FROM new_users")
+        cursor.execute("INSERT OR REPLACE INTO rollups (granularity, bucket, metric, dim, n) VALUES ('meta', '', 'backfill_done', '', ?)", (upto,))
+        cursor.execute("COMMIT")
+        return upto, bound
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
 def init_db():
     if not supabase:
         conn = sqlite3.connect(DB_PATH)
@@ -104,154 +334,479 @@ def init_db():
         columns = [column[1] for column in cursor.fetchall()]
         if 'last_active' not in columns:
             cursor.execute("ALTER TABLE users ADD COLUMN last_active DATETIME")
+        cursor.execute('''CREATE TABLE IF NOT EXISTS rollups (granularity TEXT, bucket TEXT, metric TEXT, dim TEXT, n INTEGER, PRIMARY KEY (granularity, metric, bucket, dim))''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_rollups_rank ON rollups(granularity, metric, bucket, n)")
+        cursor.execute('''CREATE TABLE IF NOT EXISTS rollup_active_users (granularity TEXT, bucket TEXT, username TEXT, PRIMARY KEY (granularity, bucket, username))''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS app_state (name TEXT PRIMARY KEY, value TEXT, updated_at REAL)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS history_archive (username TEXT PRIMARY KEY, total INTEGER, score_sum INTEGER, safe INTEGER, warning INTEGER, danger INTEGER, archived_until DATETIME)''')
+        # Pin the backfill bound before this worker counts anything live (first worker wins)
+        cursor.execute("INSERT OR IGNORE INTO rollups (granularity, bucket, metric, dim, n) SELECT 'meta', '', 'backfill_until', '', COALESCE(MAX(id), 0) FROM history")
         conn.commit(); conn.close()
     else:
         print("DB: Initialization skipped (Using Cloud Tables)")
+        try:
+            # Cloud rollups are never backfilled: pin the last uncounted history id (first worker wins)
+            res = supabase.table("history").select("id").order("id", desc=True).limit(1).execute()
+            supabase.table("app_state").upsert({"name": ROLLUP_STATE_KEY, "value": {"backfill_until": res.data[0]["id"] if res.data else 0},
+                                                "updated_at": time.time()}, ignore_duplicates=True).execute()
+        except Exception as e:
+            print(f"WARNING Rollups: Could not pin the live-count bound: {str(e)}")
 
 init_db()
 
+# Shared Cache (cross-process store for the gunicorn worker pool)
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "foodguard_cache.db")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 5000))
+CACHE_L1_ENTRIES = int(os.getenv("CACHE_L1_ENTRIES", 256))
+CACHE_L1_TTL = int(os.getenv("CACHE_L1_TTL", 30))
+CACHE_BUSY_TIMEOUT = float(os.getenv("CACHE_BUSY_TIMEOUT", 0.25))
+
+class SharedCache:
+    """SQLite (WAL) key-value store shared by every worker in the container, with a small
+    per-process LRU (L1) in front. Values are JSON; entries expire by TTL and the store is
+    trimmed to `max_entries` by least-recent access.
+
+    Calls run on the event loop, so lock waits are capped at CACHE_BUSY_TIMEOUT: past that a
+    read is a miss, `add` does not take the lease and `set`/`delete` drop the write (and return False)."""
+
+    EVICT_EVERY = 100  # Writes between eviction passes
+
+    def __init__(self, path: str, max_entries: int, l1_entries: int, l1_ttl: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.l1_entries = l1_entries
+        self.l1_ttl = l1_ttl
+        self._l1: "OrderedDict[str, tuple]" = OrderedDict()
+        self._local = threading.local()
+        self._writes = 0
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "sets": 0, "evictions": 0, "busy": 0}
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():  # Never reuse a connection across fork
+            conn = sqlite3.connect(self.path, timeout=CACHE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed_at)")
+            except sqlite3.Error:
+                conn.close()  # Setup retries on the next call
+                raise
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _busy(self, op: str, key: str, e: Exception):
+        self.stats["busy"] += 1
+        print(f"WARNING Cache: {op} {key} skipped ({str(e)})")
+
+    def _write(self, sql: str, params, key: str) -> bool:
+        try:
+            self._conn().execute(sql, params)
+            return True
+        except sqlite3.OperationalError as e:
+            self._busy("write", key, e)
+            return False
+
+    def _l1_put(self, key: str, value, ttl: float):
+        self._l1.pop(key, None)
+        self._l1[key] = (time.time() + min(ttl, self.l1_ttl), value)
+        while len(self._l1) > self.l1_entries:
+            self._l1.popitem(last=False)
+
+    def get(self, key: str, local: bool = True):
+        """Read through L1 then SQLite. Pass local=False for state other workers mutate (e.g. jobs)."""
+        now = time.time()
+        entry = self._l1.get(key) if local else None
+        if entry:
+            if entry[0] > now:
+                self._l1.move_to_end(key)
+                self.stats["l1_hits"] += 1
+                return entry[1]
+            del self._l1[key]
+
+        try:
+            row = self._conn().execute("SELECT value, expires_at, accessed_at FROM cache WHERE key=?", (key,)).fetchone()
+        except sqlite3.OperationalError as e:
+            self._busy("read", key, e)
+            row = None
+        if not row or row[1] <= now:
+            self.stats["misses"] += 1
+            return None
+        if now - row[2] > 60:  # Coarse access time keeps reads mostly write-free
+            self._write("UPDATE cache SET accessed_at=? WHERE key=?", (now, key), key)
+        value = json.loads(row[0])
+        if local: self._l1_put(key, value, row[1] - now)
+        self.stats["l2_hits"] += 1
+        return value
+
+    def set(self, key: str, value, ttl: float) -> bool:
+        """Store `value`; returns False if the shared write was dropped (L1 still gets it)."""
+        now = time.time()
+        stored = self._write(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now), key
+        )
+        self._l1_put(key, value, ttl)
+        self.stats["sets"] += 1
+        if stored: self._maybe_evict()
+        return stored
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        """Insert only if the key is absent or expired. Returns True if this call stored it (used as a lease)."""
+        now = time.time()
+        conn = None
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT expires_at FROM cache WHERE key=?", (key,)).fetchone()
+            if row and row[0] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now)
+            )
+            conn.execute("COMMIT")
+            return True
+        except sqlite3.OperationalError as e:
+            if conn is not None and conn.in_transaction: conn.execute("ROLLBACK")
+            self._busy("add", key, e)
+            return False
+        except Exception:
+            if conn is not None and conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+
+    def exists(self, key: str) -> bool:
+        try:
+            row = self._conn().execute("SELECT 1 FROM cache WHERE key=? AND expires_at > ?", (key, time.time())).fetchone()
+        except sqlite3.OperationalError as e:
+            self._busy("read", key, e)
+            return False
+        return row is not None
+
+    def delete(self, key: str) -> bool:
+        self._l1.pop(key, None)
+        return self._write("DELETE FROM cache WHERE key=?", (key,), key)
+
+    def renew(self, key: str, value, ttl: float) -> Optional[bool]:
+        """Extend a lease still holding `value`: True if renewed, False if someone else took it, None if busy."""
+        try:
+            cursor = self._conn().execute("UPDATE cache SET expires_at=? WHERE key=? AND value=?", (time.time() + ttl, key, json.dumps(value)))
+        except sqlite3.OperationalError as e:
+            self._busy("renew", key, e)
+            return None
+        return cursor.rowcount == 1
+
+    def release(self, key: str, value) -> bool:
+        """Delete a lease only if it still holds `value`."""
+        self._l1.pop(key, None)
+        return self._write("DELETE FROM cache WHERE key=? AND value=?", (key, json.dumps(value)), key)
+
+    def _maybe_evict(self):
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY: return
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            excess = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (excess,))
+                self.stats["evictions"] += excess
+        except sqlite3.OperationalError as e:
+            self._busy("evict", "*", e)  # Next pass retries
+
+shared_cache = SharedCache(CACHE_DB_PATH, CACHE_MAX_ENTRIES, CACHE_L1_ENTRIES, CACHE_L1_TTL)
+
+async def cached_compute(key: str, ttl, compute, cacheable=lambda v: v is not None, lease_ttl: float = 30):
+    """Return `key` from the shared cache, or run `compute()` once across all workers:
+    the worker holding the lease computes, the others wait for its result.
+    `ttl` may be a callable taking the computed value."""
+    value = shared_cache.get(key)
+    if value is not None: return value
+
+    lease = f"lease:{key}"
+    if shared_cache.add(lease, os.getpid(), lease_ttl):
+        try:
+            value = await compute()
+            if cacheable(value): shared_cache.set(key, value, ttl(value) if callable(ttl) else ttl)
+            return value
+        finally:
+            shared_cache.release(lease, os.getpid())  # Never drop a lease another worker took over after ours expired
+
+    deadline = time.monotonic() + lease_ttl
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+        value = shared_cache.get(key)
+        if value is not None: return value
+        if not shared_cache.exists(lease): break
+    return await compute()
+
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 def get_password_hash(password): return pwd_context.hash(password)
 def verify_password(plain_password, hashed_password): return pwd_context.verify(plain_password, hashed_password)
 
-# Comprehensive Additive Database (Clinical Profiles)
+# Additive Catalog (Clinical Profiles)
 # Classification: safe (Green), warning (Yellow/Orange), danger (Red)
-ADDITIVES_DICT = {
-    # COLORANTES (E100-E199)
-    "tartrazina": {
-        "code": "E102", "safety": "danger", "name": "Tartrazina", 
-        "harm": "Colorante azoico vinculado a hiperactividad infantil y asma bronquial.",
-        "harm_detail": "Su estructura química libera aminas aromáticas que pueden desencadenar la liberación de histamina. Se observa un impacto directo en la permeabilidad de la barrera hematoencefálica en modelos de desarrollo temprano.",
-        "risk_profile": "🧬 Genotoxicidad / 🧠 Neuroconductual", "adi_warning": "⚠️ Muy fácil de superar", 
-        "study": "EFSA / Univ. Southampton: Vínculo confirmado con falta de concentración infantil.",
-        "study_detail": "Estudio doble ciego aleatorizado (Lancet) que demostró un aumento significativo de comportamientos disruptivos en niños que consumieron mezclas de colorantes incluyendo E102."
-    },
-    "amarillo ocaso": {
-        "code": "E110", "name": "Amarillo Ocaso FCF", "safety": "danger", 
-        "harm": "Daña el sistema inmunológico y causa déficit de atención por neurotoxicidad.",
-        "harm_detail": "Actúa como un disruptor inmunológico al interferir con la respuesta de los leucocitos. En estudios celulares, se ha observado una inhibición parcial del crecimiento celular.",
-        "risk_profile": "🧬 Genotoxicity / 🛡️ Inmunotoxicidad", "adi_warning": "⚠️ Riesgo acumulativo", 
-        "study": "JECFA: Bajo revisión constante por potencial genotóxico en células mamíferas.",
-        "study_detail": "Evaluaciones de la EFSA indican que los niños pueden superar la Ingesta Diaria Admisible (IDA) consumiendo solo un par de productos industriales altamente coloreados."
-    },
-    "rojo allura": {
-        "code": "E129", "name": "Rojo Allura AC", "safety": "danger", 
-        "harm": "Inducción de colitis y cambios profundos en la barrera mucosa intestinal.",
-        "harm_detail": "Altera la microbiota intestinal aumentando bacterias pro-inflamatorias. Daña directamente las proteínas que mantienen unidas las células del colon (Tight Junctions).",
-        "risk_profile": "🦠 Microbiota / 🧬 Inflamatorio", "adi_warning": "⚠️ Ultraprocesados", 
-        "study": "Nature Communications (2022): El consumo prolongado daña directamente la mucosa del colon.",
-        "study_detail": "La exposición temprana desencadena una susceptibilidad aumentada a la enfermedad inflamatoria intestinal (EII) al degradar la capa protectora de mucina."
-    },
-    "caramelo sulfito": {"code": "E150d", "name": "Caramelo de Sulfito Amónico", "safety": "danger", "harm": "Contiene 4-MEI, subproducto de fabricación clasificado como carcinógeno.", "risk_profile": "🧬 Cáncer / 🩸 Médula Ósea", "adi_warning": "❌ Evitar consumo diario", "study": "IARC (OMS): Clasificado en el Grupo 2B (Posible carcinógeno humano)."},
-    "dioxido de titanio": {
-        "code": "E171", "name": "Dióxido de Titanio", "safety": "danger", 
-        "harm": "Nanopartículas que penetran el núcleo celular causando fragmentación del ADN.",
-        "harm_detail": "Debido a su tamaño nanométrico, las partículas cruzan las membranas celulares y se acumulan en órganos como el hígado y bazo, provocando estrés oxidativo crónico.",
-        "risk_profile": "🧬 Genotoxicidad ADN / 🫀 Vascular", "adi_warning": "🚫 Prohibido en la UE", 
-        "study": "EFSA 2021: Dictamen final de inseguridad al no poder descartar daño genético irreversible.",
-        "study_detail": "Basado en más de 200 estudios científicos que demuestran que no existe un nivel seguro de ingesta para prevenir la genotoxicidad por acumulación de partículas."
-    },
-    "carmin": {"code": "E120", "name": "Carmín / Ácido Carmínico", "safety": "danger", "harm": "Colorante derivado de insectos. Riesgo de shock anafiláctico y asma.", "risk_profile": "🧪 Alergia Grave / 🛡️ Inmune", "adi_warning": "⚠️ Evitar en alérgicos", "study": "EFSA: Casos confirmados de reacciones alérgicas graves mediadas por proteínas de insecto."},
-    "azul brillante": {"code": "E133", "name": "Azul Brillante FCF", "safety": "danger", "harm": "Colorante sintético vinculado a hiperactividad y potencial neurotoxicidad.", "risk_profile": "🧠 Neuroconductual / 🧪 Sintético", "adi_warning": "⚠️ Evitar en niños", "study": "FDA: Bajo vigilancia por asociación con THDA en subgrupos sensibles."},
-    "eritrosina": {"code": "E127", "name": "Eritrosina", "safety": "danger", "harm": "Interfiere con el metabolismo del yodo y la función tiroidea.", "risk_profile": "🦋 Tiroides / 🧬 ADN", "adi_warning": "❌ Evitar", "study": "EFSA: Restringido a usos muy específicos por riesgo hormonal."},
-
-    # CONSERVANTES (E200-E299)
-    "sorbato de potasio": {"code": "E202", "name": "Sorbato de Potasio", "safety": "warning", "harm": "Genotóxico para linfocitos humanos en dosis altas. Riesgo por acumulación.", "risk_profile": "🧬 Linfocitos / 🧪 Irritación Celular", "adi_warning": "⚠️ Muy común", "study": "Toxicology Reports: Evidencia de inducción de estrés oxidativo en mitocondrias cerebrales."},
-    "benzoato de sodio": {"code": "E211", "name": "Benzoato de Sodio", "safety": "danger", "harm": "En combinación con Vitamina C genera benceno (cancerígeno). Daño mitocondrial.", "risk_profile": "🧬 Daño ADN / ⚡ Mitotoxicidad", "adi_warning": "❌ Riesgo en bebidas ácidas", "study": "Univ. Sheffield: Vinculado a la inactivación de genes vitales en la mitocondria humana."},
-    "nitrito de sodio": {
-        "code": "E250", "name": "Nitrito de Sodio", "safety": "danger", 
-        "harm": "Formación de nitrosaminas en el estómago. Vínculo directo con cáncer colorrectal.",
-        "harm_detail": "En el entorno ácido del estómago, los nitritos reaccionan con aminas de la carne para formar Nitrosaminas, potentes carcinógenos que dañan el código genético del epitelio digestivo.",
-        "risk_profile": "🧬 Carcinogénesis ADN / 🩸 Hemoglobina", "adi_warning": "❌ Riesgo extremo en carnes", 
-        "study": "ANSES 2022: Informe final confirmando el vínculo entre nitritos y riesgo de cáncer colorrectal.",
-        "study_detail": "La OMS clasifica la carne procesada con nitritos en el Grupo 1 (Carcinógeno para humanos), compartiendo categoría con el tabaco y el amianto."
-    },
-    "sulfito de sodio": {"code": "E221", "name": "Sulfitos", "safety": "danger", "harm": "Destruye la vitamina B1. Altamente alérgeno, provoca crisis asmáticas.", "risk_profile": "🧪 Alergia / 🛡️ Vitamina B1", "adi_warning": "❌ Alerta Asma", "study": "EFSA: Obligatorio declarar a partir de 10mg/kg por riesgo de shock."},
-
-    # ANTIOXIDANTES Y FOSFATOS (E300-E399)
-    "fosfatos": {"code": "E339-E452", "name": "Fosfatos Industriales", "safety": "warning", "harm": "Calcificación vascular prematura y aceleración del envejecimiento orgánico.", "risk_profile": "🫀 Cardiovascular / 🚿 Renal / 🦴 Huesos", "adi_warning": "⚠️ Supera DDA fácilmente", "study": "Freiburg Univ. / INSERM: Asociación con fallo renal agudo en consumidores frecuentes."},
-    "acido fosforico": {"code": "E338", "name": "Ácido Fosfórico", "safety": "danger", "harm": "Desmineralización ósea profunda y cálculos renales por exceso de fósforo.", "risk_profile": " Huesos / 🚿 Renal", "adi_warning": "❌ Riesgo en refrescos", "study": "American Journal of Clinical Nutrition: Vínculo con baja densidad ósea en mujeres."},
-    "bha": {"code": "E320", "name": "BHA (Butilhidroxianisol)", "safety": "danger", "harm": "Posible carcinógeno y alterador endocrino. Daña el sistema hormonal.", "risk_profile": "🧬 Cáncer / 🦋 Endocrino", "adi_warning": "⚠️ Muy persistente", "study": "IARC: Clasificado como 2B. NIEHS: Razonablemente anticipado como carcinógeno humano."},
-
-    # ESPESANTES Y EMULGENTES (E400-E499)
-    "carragenano": {
-        "code": "E407", "name": "Carragenanos", "safety": "danger", 
-        "harm": "Inflamación intestinal sistémica y potencial desarrollo de ulceraciones de colon.",
-        "harm_detail": "Inactiva la enzima sulfatasa ácida intestinal, lo que provoca la degradación del moco protector y permite que las bacterias penetren en la lámina propia del intestino.",
-        "risk_profile": "🦠 Microbiota / 🧬 Inflamación Mucosa", "adi_warning": "❌ Evitar en sensibilidad gástrica", 
-        "study": "Int J Mol Sci: Demostró inducir intolerancia a la glucosa y disbiosis intestinal profunda.",
-        "study_detail": "Estudios en humanos muestran que su exclusión de la dieta mejora drásticamente los síntomas de pacientes con colitis ulcerosa en remisión."
-    },
-    "monogliceridos": {"code": "E471", "name": "Mono y Diglicéridos", "safety": "warning", "harm": "Emulsificantes industriales vinculados a la ruptura de la barrera intestinal.", "risk_profile": " Cardiovascular / 🩹 Permeabilidad", "adi_warning": "⚠️ Presente en ultraprocesados", "study": "The BMJ (2023): Landmark study (INSERM) vinculando E471 con mayor riesgo de infarto."},
-    "polisorbato 80": {"code": "E433", "name": "Polisorbato 80", "safety": "danger", "harm": "Detergente industrial que 'limpia' la mucosa protectora del intestino.", "risk_profile": " Barrera Intestinal /  Microbiota", "adi_warning": "⚠️ Riesgo Crohn/Colitis", "study": "Nature: Demostró promover la inflamación crónica en modelos animales."},
-    "carboximetilcelulosa": {
-        "code": "E466", "name": "CMC / Goma Celulosa", "safety": "danger", 
-        "harm": "Altera drásticamente la composición de la microbiota hacia un perfil inflamatorio.",
-        "harm_detail": "Reduce la distancia entre las bacterias del lumen y el epitelio intestinal, forzando al sistema inmune a estar en alerta constante, lo que deriva en síndrome metabólico.",
-        "risk_profile": "🦠 Microbiota / 🩹 Inflamación", "adi_warning": "⚠️ Evitar en UPFs", 
-        "study": "Gastroenterology: El consumo humano altera la composición de bacterias intestinales en solo 11 días.",
-        "study_detail": "Primer estudio clínico controlado en humanos que demuestra pérdida de diversidad bacteriana y depleción de metabolitos beneficiosos para la salud."
-    },
-    "difosfatos": {"code": "E450", "name": "Difosfatos / Polifosfatos", "safety": "danger", "harm": "Interfieren con la absorción de calcio. Riesgo vascular severo.", "risk_profile": " Vascular / 🦴 Minerales", "adi_warning": "⚠️ Riesgo de calcificación", "study": "EFSA 2019: Re-evaluación que redujo la ingesta aceptable por riesgos renales."},
-    "gomas": {"code": "E410-E415", "name": "Gomas (Garrofín, Guar, Xantana)", "safety": "warning", "harm": "Alteración del grosor de la mucina intestinal, facilitando paso de toxinas.", "risk_profile": "🦠 Microbiota / 🩹 Mucosa", "adi_warning": "⚠️ Muy frecuentes", "study": "Cell Host & Microbe: Observación de adelgazamiento de la barrera protectora intestinal."},
-    "glicerol": {"code": "E422", "name": "Glicerol / Glicerina", "safety": "warning", "harm": "Solvente industrial refinado. Marcador de alimentos ultra-transformados.", "risk_profile": "🧪 Refinado / 🚽 Osmótico", "adi_warning": "⚠️ Indicador industrial", "study": "EFSA 2023: Re-evaluación prioritaria para limitar impurezas como la acroleína."},
-    "sorbitol": {"code": "E420", "name": "Sorbitoles", "safety": "warning", "harm": "Poliol edulcorante. Causa hinchazón, gases y alteración de flora bacteriana.", "risk_profile": "🦠 Microbiota / 🚽 Malestar", "adi_warning": "🚫 Prohibido en bebidas infantiles", "study": "Gastroenterology: Asociación con disbiosis intestinal profunda en consumo diario."},
-    "e420i": {"code": "E420i", "name": "Sorbitol", "safety": "warning", "harm": "Utilizado para mantener humedad. Perturba la microbiota intestinal.", "risk_profile": "🦠 Microbiota / 🚽 Digestivo", "adi_warning": "⚠️ Riesgo limitado", "study": "EFSA: Evaluación técnica de polioles y salud gástrica."},
-    "pectina": {"code": "E440", "name": "Pectinas", "safety": "warning", "harm": "Aunque de origen vegetal, su extracción industrial la marca como riesgo limitado.", "risk_profile": "🦠 Microbiota", "adi_warning": "⚠️ Riesgo limitado", "study": "EFSA: Evaluación de seguridad para uso alimentario."},
-
-    # GASIFICANTES Y REFINADOS (E500+)
-    "bicarbonato": {"code": "E500", "safety": "warning", "name": "Bicarbonato de Sodio", "harm": "Sal refinada industrial. Indica producto altamente transformado.", "risk_profile": "🧪 Industrial / ⚖️ Balance pH", "adi_warning": "⚠️ Consumo limitado", "study": "EFSA 2024 (Call for Data): Vigilancia ante impurezas metálicas (Aluminio) en aditivos minerales."},
-    "carbonatos": {"code": "E500/E503", "safety": "warning", "name": "Carbonatos Sódicos/Amónicos", "harm": "Químicos de horneado industrial. Irritantes para el estómago.", "risk_profile": "🚽 Digestivo / 🧪 Químico", "adi_warning": "⚠️ Ultraprocesado", "study": "EFSA 2023: Evaluación de seguridad para lactantes y niños pequeños."},
-    "carbonatos de sodio": {"code": "E500", "safety": "warning", "name": "Carbonatos de Sodio", "harm": "Gasificante industrial. Riesgo limitado para la salud.", "risk_profile": "🧪 Industrial", "adi_warning": "⚠️ Riesgo limitado", "study": "EFSA."},
-    "aroma": {"code": "AROMA", "safety": "warning", "name": "Aromas / Aromatizantes", "harm": "Opacidad clínica. Puede incluir disolventes y conservantes no declarados.", "risk_profile": "🧪 Opacidad / 💡 Desconocido", "adi_warning": "⚠️ Evitar en niños", "study": "INSERM (NutriNet-Santé): Consumo de aromas industriales asociado a mayor riesgo metabólico."},
-    "aroma artificial": {"code": "AROMA", "safety": "warning", "name": "Aroma Artificial", "harm": "Sustancias químicas de síntesis. Falta de transparencia en composición.", "risk_profile": "🧪 Sintético / 🧪 Opacidad", "adi_warning": "⚠️ Riesgo acumulativo", "study": "INSERM: Los aromas sintéticos forman parte del conjunto de riesgo de alimentos ultraprocesados."},
-
-    # POTENCIADORES DEL SABOR
-    "glutamato monosodico": {
-        "code": "E621", "safety": "danger", "name": "Glutamato Monosódico (MSG)", 
-        "harm": "Neuroexcitotoxina. Vinculado a migrañas y sobreestimulación del apetito.",
-        "harm_detail": "Sobreestimula los receptores de glutamato en el cerebro, lo que puede causar fatiga neuronal. Además, altera la señalización de leptina, la hormona que nos dice que estamos saciados.",
-        "risk_profile": "🧠 Neurosensibilidad / 🧪 Excitotoxicidad", "adi_warning": "⚠️ Complejo de síntomas MSG", 
-        "study": "FDA / FASEB: Reconoce 'Complejo de Síntomas MSG' (dolor de cabeza, palpitaciones) en dosis de 3g+.",
-        "study_detail": "Uso extensivo en la industria para enmascarar ingredientes de baja calidad y forzar el consumo repetitivo mediante la excitación de los receptores umami."
-    },
-
-    # EDULCORANTES
-    "aspartamo": {"code": "E951", "safety": "danger", "name": "Aspartamo", "harm": "Neurotoxicidad y alteración de los mecanismos de saciedad y glucosa sanguínea.", "risk_profile": "🧠 Neuro / ⚖️ Insulina / 🧬 DNA", "adi_warning": "❌ IARC 2023: 2B", "study": "IARC 2023 / INSERM: Clasificado como posiblemente cancerígeno con evidencia en cáncer de mama."},
-
-    # SEGUROS (Verificados)
-    "lecitina": {"code": "E322", "safety": "safe", "name": "Lecitina (Soja/Girasol)", "harm": "Lípido esencial beneficioso para la función neuronal y hepática.", "harm_detail": "Fuente natural de colina e inositol. Nutrientes vitales para la formación de membranas celulares y el transporte de grasas.", "risk_profile": "🧠 Salud / ✅ Seguro", "adi_warning": "✅ Sin límite", "study": "EFSA: Evaluación positiva recurrente por beneficios en el perfil lipídico.", "study_detail": "Dictámenes técnicos constantes confirman su seguridad absoluta y su rol como nutriente esencial en la dieta humana."},
-    "e322i": {"code": "E322i", "safety": "safe", "name": "Lecitina de Soja", "harm": "Emulgente seguro de origen vegetal.", "risk_profile": "✅ Seguro", "adi_warning": "✅ Seguro", "study": "EFSA Panel on Food Additives."},
-    "acido ascorbico": {"code": "E300", "safety": "safe", "name": "Vitamina C", "harm": "Antioxidante hidrosoluble natural. Factor clave para el colágeno.", "risk_profile": "🛡️ Celular / ✅ Seguro", "adi_warning": "✅ Seguro", "study": "Nutriente esencial clínica."},
-    "acido citrico": {"code": "E330", "safety": "safe", "name": "Ácido Cítrico", "harm": "Regulador de acidez natural y seguro en dosis convencionales.", "harm_detail": "Intermediario clave en el ciclo de Krebs. Nuestro cuerpo lo procesa de forma natural y eficiente.", "risk_profile": "⚖️ Metabolismo / ✅ Seguro", "adi_warning": "✅ Seguro", "study": "Molécula metabólica natural (Kreb's).", "study_detail": "Evaluación de la EFSA confirma que no hay riesgos de seguridad, incluso en ingestas elevadas, dada su naturaleza endógena."}
-}
+# Source of truth is additives.json; it is compiled once per load and hot-reloaded on change.
+ADDITIVES_PATH = os.getenv("ADDITIVES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "additives.json"))
+ADDITIVES_RELOAD_INTERVAL = float(os.getenv("ADDITIVES_RELOAD_INTERVAL", 5))
+
+class AdditiveCatalog:
+    """Immutable, compiled view of additives.json.
+
+    Entries are stored once in the `details` tuple (strings interned, identical entries
+    deduplicated); the code, alias and fallback-range indexes refer to them by position."""
+
+    def __init__(self, raw: dict, digest: str):
+        self.version = f"{raw.get('version', '0')}+{digest[:8]}"
+        details, seen = [], {}
+        code_index: Dict[str, int] = {}
+        alias_index: List[tuple] = []  # (alias, detail id) in file order; used for ingredient matching
+
+        def intern_detail(d: dict) -> int:
+            d = {sys.intern(k): sys.intern(v) if isinstance(v, str) else v for k, v in d.items()}
+            key = json.dumps(d, sort_keys=True, ensure_ascii=False)
+            if key not in seen:
+                seen[key] = len(details)
+                details.append(d)
+            return seen[key]
+
+        for entry in raw.get("additives", []):
+            idx = intern_detail(entry["detail"])
+            for alias in entry.get("aliases", []):
+                alias_index.append((sys.intern(alias.lower()), idx))
+            for code in entry.get("codes", []):
+                code_index[sys.intern(code.upper())] = idx
+
+        fallback = raw.get("fallback", {})
+        ranges = sorted(fallback.get("ranges", []), key=lambda r: r["min"])
+        self.code_index = code_index
+        self.alias_index = tuple(alias_index)
+        self.alias_map = {a: i for a, i in reversed(alias_index)}  # First alias wins, like dict order
+        self.range_lows = tuple(r["min"] for r in ranges)
+        self.range_highs = tuple(r["max"] for r in ranges)
+        self.range_details = tuple(intern_detail(r["detail"]) for r in ranges)
+        self.fallback_default = intern_detail(fallback["default"])
+        self.fallback_unknown = intern_detail(fallback["unknown"])
+        self.details = tuple(details)
+        self.search_index = AdditiveSearchIndex(self)
+        self._detail_ids = {id(d): i for i, d in enumerate(self.details)}
+        self._payloads: Dict[object, "EncodedPayload"] = {}
+
+    def by_code(self, code: str) -> Optional[dict]:
+        idx = self.code_index.get(code.upper())
+        return self.details[idx] if idx is not None else None
+
+    def by_alias(self, alias: str) -> Optional[dict]:
+        idx = self.alias_map.get(alias)
+        return self.details[idx] if idx is not None else None
+
+    def aliases(self):
+        for alias, idx in self.alias_index:
+            yield alias, self.details[idx]
+
+    def fallback(self, code: str) -> dict:
+        """Deep Clinical Fallback for missing E-codes based on institutional risk ranges."""
+        code = code.upper()
+        match = re.search(r'\d+', code)
+        if not match:
+            template = self.details[self.fallback_unknown]
+        else:
+            num = int(match.group())
+            pos = bisect.bisect_right(self.range_lows, num) - 1
+            if pos >= 0 and num <= self.range_highs[pos]:
+                template = self.details[self.range_details[pos]]
+            else:
+                template = self.details[self.fallback_default]
+        return {**template, "name": template["name"].format(code=code)}
+
+    def payload(self, detail: dict) -> "EncodedPayload":
+        """Response body for an entry or fallback detail, encoded once per catalog version."""
+        key = self._detail_ids.get(id(detail), detail.get("name"))
+        cached = self._payloads.get(key)
+        if cached is None:
+            if len(self._payloads) >= len(self.details) + 1024: self._payloads.clear()  # Bound fallback entries
+            cached = self._payloads[key] = EncodedPayload(detail)
+        return cached
+
+def fold_text(text: str) -> str:
+    """Lowercase, strip accents and collapse punctuation so 'Dióxido' matches 'dioxido'."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+def _edit_distance(a: str, b: str, max_dist: int) -> int:
+    """Levenshtein distance with early exit once every path exceeds max_dist."""
+    if abs(len(a) - len(b)) > max_dist: return max_dist + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+        if min(cur) > max_dist: return max_dist + 1
+        prev = cur
+    return prev[-1]
+
+class AdditiveSearchIndex:
+    """Ranked search over codes, names and aliases of one AdditiveCatalog.
+
+    Prefix lookups bisect sorted vocabularies of whole terms and of single words (same role
+    as a trie, without per-node dicts). Substring and typo-tolerant lookups go through a
+    trigram index over the word vocabulary and are verified with a bounded edit distance."""
+
+    EXACT, CODE_EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = 100, 95, 80, 60, 40, 30
+    MAX_PREFIX_SCAN = 256  # Bound on completions inspected for very short prefixes
+
+    def __init__(self, catalog: "AdditiveCatalog"):
+        # term -> True if it comes from a name or alias, False if only from a code. An exact name/alias
+        # match outranks an exact code match ("aroma" is an alias of one entry, the code of another).
+        doc_terms: Dict[int, Dict[str, bool]] = {}
+        for alias, idx in catalog.alias_index:
+            doc_terms.setdefault(idx, {})[fold_text(alias)] = True
+        for code, idx in catalog.code_index.items():
+            doc_terms.setdefault(idx, {}).setdefault(fold_text(code).replace(" ", ""), False)
+        for idx, terms in doc_terms.items():
+            detail = catalog.details[idx]
+            terms[fold_text(detail["name"])] = True
+            terms.setdefault(fold_text(detail["code"]).replace(" ", ""), False)
+
+        term_docs: Dict[str, Dict[int, int]] = {}
+        word_docs: Dict[str, set] = {}
+        for idx, terms in doc_terms.items():
+            for term, from_text in terms.items():
+                exact = self.EXACT if from_text else self.CODE_EXACT
+                term_docs.setdefault(term, {})[idx] = max(exact, term_docs.get(term, {}).get(idx, 0))
+                for w in term.split():
+                    word_docs.setdefault(w, set()).add(idx)
+        grams: Dict[str, List[int]] = {}
+        words = sorted(word_docs)
+        for wid, word in enumerate(words):
+            for g in self._trigrams(word):
+                grams.setdefault(g, []).append(wid)
+
+        self.catalog = catalog
+        self.terms = tuple(sorted(term_docs))
+        self.term_docs = tuple(tuple(term_docs[t].items()) for t in self.terms)  # ((idx, exact score), ...)
+        self.words = tuple(words)
+        self.word_docs = tuple(tuple(word_docs[w]) for w in words)
+        self.grams = {g: tuple(ids) for g, ids in grams.items()}
+
+    @staticmethod
+    def _trigrams(term: str):
+        padded = f"  {term} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def normalize_query(q: str):
+        """Return (folded query, is_code). Code-like queries ("102", "e 102", "E-102") use the compact code form."""
+        q = fold_text(q)
+        if re.fullmatch(r"e?\s?\d[\da-z ]*", q):
+            q = q.replace(" ", "")
+            return (q if q.startswith("e") else f"e{q}"), True
+        return q, False
+
+    def _prefix_ids(self, vocab: tuple, prefix: str):
+        pos = bisect.bisect_left(vocab, prefix)
+        end = min(len(vocab), pos + self.MAX_PREFIX_SCAN)
+        while pos < end and vocab[pos].startswith(prefix):
+            yield pos
+            pos += 1
+
+    def search(self, query: str, limit: int = 10, fuzzy: bool = True) -> List[tuple]:
+        """Return up to `limit` (score, detail) pairs, best first."""
+        q, is_code = self.normalize_query(query)
+        if not q: return []
+        scores: Dict[int, int] = {}
+
+        def hit(docs, score: int):
+            for idx in docs:
+                if score > scores.get(idx, 0): scores[idx] = score
+
+        # 1. Whole-term exact and prefix matches (shorter completions rank first)
+        for tid in self._prefix_ids(self.terms, q):
+            term = self.terms[tid]
+            if term == q:
+                for idx, exact in self.term_docs[tid]: hit((idx,), exact)
+            else:
+                hit([idx for idx, _ in self.term_docs[tid]], self.PREFIX - min(len(term) - len(q), 15))
+
+        q_words = q.split()
+        if len(q_words) > 1:
+            # 2a. Multi-word queries: every word must start some word of the entry, in any order
+            matched = None
+            for w in q_words:
+                docs = {idx for wid in self._prefix_ids(self.words, w) for idx in self.word_docs[wid]}
+                matched = docs if matched is None else matched & docs
+            hit(matched or (), self.WORD_PREFIX - 5)
+        else:
+            # 2b. Single word: word prefix, then substring / typo-tolerant matches over the vocabulary
+            for wid in self._prefix_ids(self.words, q):
+                hit(self.word_docs[wid], self.WORD_PREFIX - min(len(self.words[wid]) - len(q), 15))
+
+            fuzzy = fuzzy and not is_code and len(q) >= 3 and len(scores) < limit  # A mistyped code is a different additive
+            q_grams = self._trigrams(q)
+            inner = [g for g in q_grams if g[0] != " " and g[-1] != " "]
+            counts: Dict[int, int] = {}
+            for g in (q_grams if fuzzy else inner):
+                for wid in self.grams.get(g, ()):
+                    counts[wid] = counts.get(wid, 0) + 1
+            substring_min = len(inner)              # A substring carries every interior trigram
+            fuzzy_min = -(-len(q_grams) // 2)       # A typo or two still leaves half of them
+            max_dist = 1 if len(q) <= 5 else 2
+            for wid, shared in counts.items():
+                word = self.words[wid]
+                if word.startswith(q): continue
+                if shared >= substring_min and q in word:
+                    hit(self.word_docs[wid], self.SUBSTRING)
+                elif fuzzy and shared >= fuzzy_min:
+                    dist = _edit_distance(q, word[:len(q) + max_dist], max_dist)
+                    if dist <= max_dist:
+                        hit(self.word_docs[wid], self.FUZZY - 5 * dist)
+
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda s: (-s[1], self.catalog.details[s[0]]["name"]))
+        return [(score, self.catalog.details[idx]) for idx, score in ranked]
+
+class CatalogStore:
+    """Holds the current AdditiveCatalog and swaps it atomically when the data file changes.
+    In-flight requests keep the catalog object they already read, so reloads drop nothing."""
+
+    def __init__(self, path: str, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.current = self._load()
+
+    def _load(self) -> AdditiveCatalog:
+        with open(self.path, "rb") as f:
+            blob = f.read()
+        self._mtime = os.stat(self.path).st_mtime_ns
+        catalog = AdditiveCatalog(json.loads(blob), hashlib.sha1(blob).hexdigest())
+        print(f"CATALOG: Loaded additives {catalog.version} ({len(catalog.details)} entries)")
+        return catalog
+
+    def get(self) -> AdditiveCatalog:
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.check_interval
+                if os.stat(self.path).st_mtime_ns != self._mtime:
+                    self.current = self._load()
+            except Exception as e:
+                # Keep serving the previous version if the new file is missing or invalid
+                print(f"WARNING Catalog: Reload failed, keeping {self.current.version}: {str(e)}")
+            finally:
+                self._lock.release()
+        return self.current
+
+additives_catalog = CatalogStore(ADDITIVES_PATH, ADDITIVES_RELOAD_INTERVAL)
 
-# Simplified database for code-based lookup
-ADDITIVES_DB = {v["code"]: v for v in ADDITIVES_DICT.values() if "code" in v}
-# Supplement with individual codes for multi-code entries
-ADDITIVES_DB["E410"] = ADDITIVES_DICT["gomas"] 
-ADDITIVES_DB["E412"] = ADDITIVES_DICT["gomas"]
-ADDITIVES_DB["E415"] = ADDITIVES_DICT["gomas"]
-ADDITIVES_DB["E500"] = ADDITIVES_DICT["bicarbonato"]
-ADDITIVES_DB["E503"] = ADDITIVES_DICT["carbonatos"]
-ADDITIVES_DB["E422"] = ADDITIVES_DICT["glicerol"]
-ADDITIVES_DB["E420"] = ADDITIVES_DICT["sorbitol"]
-ADDITIVES_DB["E420i"] = ADDITIVES_DICT["e420i"]
-ADDITIVES_DB["E322i"] = ADDITIVES_DICT["e322i"]
-ADDITIVES_DB["E621"] = ADDITIVES_DICT["glutamato monosodico"]
-ADDITIVES_DB["E120"] = ADDITIVES_DICT["carmin"]
-ADDITIVES_DB["E133"] = ADDITIVES_DICT["azul brillante"]
-ADDITIVES_DB["E338"] = ADDITIVES_DICT["acido fosforico"]
-ADDITIVES_DB["E433"] = ADDITIVES_DICT["polisorbato 80"]
-ADDITIVES_DB["E466"] = ADDITIVES_DICT["carboximetilcelulosa"]
-ADDITIVES_DB["E450"] = ADDITIVES_DICT["difosfatos"]
-ADDITIVES_DB["E452"] = ADDITIVES_DICT["difosfatos"]
-ADDITIVES_DB["E320"] = ADDITIVES_DICT["bha"]
-ADDITIVES_DB["E627"] = {"code": "E627", "safety": "danger", "name": "Guanilato Sódico", "harm": "Potenciador de sabor que aumenta el ácido úrico. Riesgo para personas con gota.", "risk_profile": "🦴 Ácido Úrico / 🧠 Excitotóxico", "adi_warning": "⚠️ Riesgo Gota", "study": "EFSA: Evaluación de nucleótidos y salud metabólica."}
-ADDITIVES_DB["E631"] = {"code": "E631", "safety": "danger", "name": "Inosinato Sódico", "harm": "Estimulante del apetito. Altera el umbral de saciedad.", "risk_profile": "⚖️ Metabolismo / 🧠 Neuro", "adi_warning": "⚠️ Evitar en control peso", "study": "JECFA: Evaluación técnica de potenciadores umami."}
-ADDITIVES_DB["E150c"] = {"code": "E150c", "safety": "warning", "name": "Caramelo Amónico", "harm": "Colorante industrial. Puede contener trazas de 4-MEI.", "risk_profile": "🧪 Industrial / 🧬 Cáncer (Límite)", "adi_warning": "⚠️ Moderar", "study": "EFSA 2017: Re-evaluación de colorantes caramelo."}
-ADDITIVES_DB["E220"] = {"code": "E220", "safety": "danger", "name": "Dióxido de Azufre (Sulfitos)", "harm": "Alérgeno severo. Destruye la vitamina B1 y causa asma.", "risk_profile": "🧪 Alergia / 🛡️ Vitamina B1", "adi_warning": "❌ Muy alérgico", "study": "EFSA: Alerta obligatoria por toxicidad sistémica."}
+def get_catalog() -> AdditiveCatalog:
+    return additives_catalog.get()
 
 # Models
 class UserAuth(BaseModel): username: str; password: str
@@ -285,6 +840,63 @@ class AnalysisResponse(BaseModel):
     categories: List[str] = []
     alternatives: List[Alternative] = []
 
+# Response Encoding
+# Hot endpoints negotiate the body format: MessagePack when the client asks for it in Accept,
+# otherwise orjson-encoded JSON. EncodedPayload keeps each format's bytes, so a cached object
+# (an additive detail, a cached analysis) is serialized once and served as-is afterwards.
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+ENCODERS = {
+    "json": ("application/json", lambda content: orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)),
+    "msgpack": ("application/msgpack", lambda content: msgpack.packb(content, use_bin_type=True)),
+}
+
+def negotiate_format(request: Request) -> str:
+    """MessagePack if Accept lists it with at least the q-value given to application/json."""
+    msgpack_q, json_q = 0.0, 0.0
+    for part in request.headers.get("accept", "").split(","):
+        media, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try: q = float(value)
+                except ValueError: q = 0.0
+        media = media.strip().lower()
+        if media in MSGPACK_MEDIA_TYPES: msgpack_q = max(msgpack_q, q)
+        elif media == "application/json": json_q = max(json_q, q)
+    return "msgpack" if msgpack_q > 0 and msgpack_q >= json_q else "json"
+
+class EncodedPayload:
+    """JSON-compatible content plus its encoded bodies, built lazily once per format."""
+    __slots__ = ("_content", "_blobs")
+
+    def __init__(self, content=None, json_blob: Optional[bytes] = None):
+        self._content = content
+        self._blobs: Dict[str, bytes] = {"json": json_blob} if json_blob is not None else {}
+
+    @classmethod
+    def from_model(cls, model: BaseModel) -> "EncodedPayload":
+        """Seed the JSON body from pydantic's serializer; content is decoded only if another format needs it."""
+        return cls(json_blob=model.model_dump_json().encode())
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = orjson.loads(self._blobs["json"])
+        return self._content
+
+    def encode(self, fmt: str) -> bytes:
+        blob = self._blobs.get(fmt)
+        if blob is None:
+            blob = self._blobs[fmt] = ENCODERS[fmt][1](self.content)
+        return blob
+
+def encoded_response(request: Request, content=None, payload: Optional[EncodedPayload] = None, status_code: int = 200) -> Response:
+    if payload is None:
+        payload = EncodedPayload(content if isinstance(content, (dict, list)) else jsonable_encoder(content))
+    fmt = negotiate_format(request)
+    return Response(payload.encode(fmt), status_code=status_code, media_type=ENCODERS[fmt][0], headers={"Vary": "Accept"})
+
 # Routes
 @app.get("/daily-tip")
 def get_daily_tip():
@@ -346,6 +958,18 @@ async def get_ia_history_items(request: Dict[str, str]):
 def debug_ia_history():
     return {"status": "Route active", "info": "Use POST with username"}
 
+# Gemini results and rate-limit state live in the shared cache so every worker benefits
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", 24 * 3600))
+GEMINI_COOLDOWN_SECONDS = int(os.getenv("GEMINI_COOLDOWN_SECONDS", 60))
+
+def gemini_model_available(model_name: str) -> bool:
+    return not shared_cache.exists(f"gemini:cooldown:{model_name}")
+
+def gemini_note_error(model_name: str, error: str):
+    """After a quota error, skip the model in every worker until the cooldown expires."""
+    if "429" in error or "Quota" in error:
+        shared_cache.set(f"gemini:cooldown:{model_name}", 1, GEMINI_COOLDOWN_SECONDS)
+
 @app.post("/generate-recipes", response_model=RecipeResponse)
 async def generate_recipes(request: RecipeRequest):
     if not GEMINI_API_KEY:
@@ -376,6 +1000,12 @@ async def generate_recipes(request: RecipeRequest):
     }}
     """
     
+    cache_key = "gemini:recipes:" + hashlib.sha1(json.dumps(sorted(i.strip().lower() for i in request.ingredients)).encode()).hexdigest()
+    cached = shared_cache.get(cache_key)
+    if cached is not None:
+        print("DEBUG Gemini: Recipes served from cache")
+        return RecipeResponse(**cached)
+
     try:
         # Tried models in order of preference based on list_models() diagnostic
         model_names = ['gemini-2.0-flash', 'gemini-flash-latest', 'gemini-pro-latest']
@@ -384,6 +1014,9 @@ async def generate_recipes(request: RecipeRequest):
         last_err = None
         
         for m_name in model_names:
+            if not gemini_model_available(m_name):
+                print(f"DEBUG Gemini: Skipping {m_name} (cooling down after quota error)")
+                continue
             try:
                 print(f"DEBUG Gemini: Trying model {m_name}...")
                 model = genai.GenerativeModel(m_name)
@@ -393,6 +1026,7 @@ async def generate_recipes(request: RecipeRequest):
                 break
             except Exception as e:
                 print(f"DEBUG Gemini: Fail with {m_name}: {str(e)}")
+                gemini_note_error(m_name, str(e))
                 last_err = e
                 continue
         
@@ -408,7 +1042,9 @@ async def generate_recipes(request: RecipeRequest):
              text = text.split("```")[1].strip()
         
         data = json.loads(text)
-        return RecipeResponse(**data)
+        result = RecipeResponse(**data)
+        shared_cache.set(cache_key, jsonable_encoder(result), GEMINI_CACHE_TTL)
+        return result
     except Exception as e:
         print(f"ERROR Gemini Final Exception: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error IA: {str(e)}")
@@ -450,16 +1086,16 @@ async def save_settings(data: UserSettings):
     return {"ok": True}
 
 @app.get("/history/{username}")
-async def get_history(username: str):
+async def get_history(username: str, http_request: Request):
     history = db_get_history(username, limit=20)
     # Uniform format for Frontend
-    return [{
+    return encoded_response(http_request, [{
         "barcode": h.get("barcode"), 
         "name": h.get("product_name") or h.get("name"), 
         "status": h.get("status"), 
         "score": h.get("score"), 
         "date": h.get("timestamp") or h.get("date")
-    } for h in history]
+    } for h in history])
 
 @app.post("/analyze-ingredients-image")
 async def analyze_ingredients_image(request: VisionRequest):
@@ -471,6 +1107,11 @@ async def analyze_ingredients_image(request: VisionRequest):
             img_data = img_data.split(",")[1]
         
         image_bytes = base64.b64decode(img_data)
+        cache_key = "gemini:vision:" + hashlib.sha1(image_bytes).hexdigest()
+        cached = shared_cache.get(cache_key)
+        if cached is not None:
+            print("DEBUG Vision: Served from cache")
+            return cached
         
         # Absolute priority list: 2.0-flash -> 1.5-flash -> 1.5-flash-8b -> 1.5-pro (last resort)
         models_to_try = ['gemini-2.0-flash', 'gemini-1.5-flash', 'gemini-1.5-flash-8b', 'gemini-1.5-pro']
@@ -478,6 +1119,9 @@ async def analyze_ingredients_image(request: VisionRequest):
         
         last_error = ""
         for model_name in models_to_try:
+            if not gemini_model_available(model_name):
+                print(f"DEBUG Vision: Skipping {model_name} (cooling down after quota error)")
+                continue
             for attempt in range(2): # Double attempt per model
                 try:
                     print(f"DEBUG Vision: Trying {model_name} (Attempt {attempt+1})")
@@ -489,12 +1133,15 @@ async def analyze_ingredients_image(request: VisionRequest):
                     text = response.text.strip()
                     if text:
                         ingredients = [i.strip() for i in text.split(",") if i.strip()]
-                        return {"ingredients": ingredients, "model": model_name}
+                        result = {"ingredients": ingredients, "model": model_name}
+                        shared_cache.set(cache_key, result, GEMINI_CACHE_TTL)
+                        return result
                 except Exception as e:
                     last_error = str(e)
                     print(f"WARNING Vision: {model_name} failed: {last_error}")
                     if "429" in last_error or "Quota" in last_error:
-                        await asyncio.sleep(2) # Give it a breath
+                        gemini_note_error(model_name, last_error)
+                        break # Next model; this one is cooling down
                     continue
         
         # If absolutely everything fails, let's not return a 500. 
@@ -505,6 +1152,155 @@ async def analyze_ingredients_image(request: VisionRequest):
         print(f"ERROR Vision overall: {str(e)}")
         return {"ingredients": [], "error": str(e)}
 
+# Background Jobs (submit-and-poll for long-running Gemini work)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 50))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 900))
+JOB_MAX_WAIT = 25  # Long-poll cap, below typical proxy timeouts
+JOB_TERMINAL = {"done", "error", "cancelled"}
+
+class JobQueue:
+    """Bounded priority queue drained by a fixed pool of asyncio workers.
+
+    Job state and results are kept in the shared cache (TTL-bound) so a client can poll
+    any gunicorn worker; cancellation is a flag in that state which the owning worker
+    checks while the job runs."""
+
+    def __init__(self, workers: int, maxsize: int, result_ttl: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.result_ttl = result_ttl
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.running: Dict[str, asyncio.Task] = {}
+        self._seq = itertools.count()
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue(maxsize=self.maxsize)
+        for _ in range(self.workers):
+            asyncio.create_task(self._worker())
+
+    def _save(self, job: dict):
+        if not shared_cache.set(f"job:{job['id']}", job, self.result_ttl):
+            raise HTTPException(status_code=503, detail="Almacén de trabajos ocupado, inténtalo de nuevo", headers={"Retry-After": "1"})
+
+    async def _persist(self, job: dict, attempts: int = 3):
+        for attempt in range(attempts):
+            try:
+                return self._save(job)
+            except HTTPException:
+                if attempt == attempts - 1: raise
+                await asyncio.sleep(0.1 * (attempt + 1))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return shared_cache.get(f"job:{job_id}", local=False)
+
+    def submit(self, kind: str, factory, priority: int) -> dict:
+        """Queue `factory()` (a coroutine factory). Lower priority values run first."""
+        if self.queue is None or self.queue.full():
+            raise HTTPException(status_code=503, detail="Cola de trabajos llena, inténtalo más tarde", headers={"Retry-After": "10"})
+        job = {"id": uuid.uuid4().hex, "kind": kind, "status": "queued", "created_at": time.time()}
+        self._save(job)
+        self.queue.put_nowait((priority, next(self._seq), job["id"], factory))
+        print(f"DEBUG Jobs: Queued {kind} job {job['id']} (priority {priority}, depth {self.queue.qsize()})")
+        return job
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        job = self.get(job_id)
+        if not job or job["status"] in JOB_TERMINAL: return job
+        job["status"] = "cancelled" if job["status"] == "queued" else "cancelling"
+        self._save(job)
+        task = self.running.get(job_id)
+        if task: task.cancel()
+        return job
+
+    async def _worker(self):
+        while True:
+            _, _, job_id, factory = await self.queue.get()
+            try:
+                await self._run(job_id, factory)
+            except Exception as e:
+                # A storage or bookkeeping failure fails this job only; the worker keeps draining the queue
+                print(f"ERROR Jobs: Job {job_id} failed: {str(e)}")
+                traceback.print_exc()
+                task = self.running.get(job_id)
+                if task and not task.done(): task.cancel()
+                try:
+                    try:
+                        job = self.get(job_id) or {"id": job_id}
+                    except Exception:
+                        job = {"id": job_id}
+                    job.update(status="error", error=str(e), finished_at=time.time())
+                    await self._persist(job)
+                except Exception as save_error:
+                    print(f"ERROR Jobs: Could not record failure of {job_id}: {str(save_error)}")
+            finally:
+                self.running.pop(job_id, None)
+                self.queue.task_done()
+
+    async def _run(self, job_id: str, factory):
+        job = self.get(job_id)
+        for _ in range(2):  # A busy shared cache reads as a miss; look again before dropping the job
+            if job: break
+            await asyncio.sleep(0.1)
+            job = self.get(job_id)
+        if not job or job["status"] != "queued": return  # Cancelled or expired while waiting
+        job.update(status="running", started_at=time.time())
+        await self._persist(job)
+        task = asyncio.create_task(factory())
+        self.running[job_id] = task
+        while not task.done():
+            await asyncio.wait({task}, timeout=0.5)
+            # Cancellation may have been requested through another worker process
+            state = self.get(job_id)
+            if not task.done() and state and state["status"] == "cancelling":
+                task.cancel()
+        try:
+            job.update(status="done", result=jsonable_encoder(task.result()))
+        except asyncio.CancelledError:
+            job.update(status="cancelled")
+        except HTTPException as e:
+            job.update(status="error", error=e.detail)
+        except Exception as e:
+            job.update(status="error", error=str(e))
+        job["finished_at"] = time.time()
+        await self._persist(job)
+        print(f"DEBUG Jobs: {job['kind']} job {job_id} finished with status {job['status']}")
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RESULT_TTL)
+
+@app.on_event("startup")
+async def start_job_workers():
+    job_queue.start()
+
+@app.post("/jobs/analyze-ingredients-image", status_code=202)
+async def submit_vision_job(request: VisionRequest):
+    job = job_queue.submit("analyze-ingredients-image", lambda: analyze_ingredients_image(request), priority=0)
+    return {"job_id": job["id"], "status": job["status"], "poll": f"/jobs/{job['id']}"}
+
+@app.post("/jobs/generate-recipes", status_code=202)
+async def submit_recipes_job(request: RecipeRequest):
+    job = job_queue.submit("generate-recipes", lambda: generate_recipes(request), priority=1)
+    return {"job_id": job["id"], "status": job["status"], "poll": f"/jobs/{job['id']}"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Job state; with `wait` the call long-polls (up to JOB_MAX_WAIT s) until the job finishes."""
+    deadline = time.monotonic() + min(max(wait, 0), JOB_MAX_WAIT)
+    job = job_queue.get(job_id)
+    while job and job["status"] not in JOB_TERMINAL and time.monotonic() < deadline:
+        await asyncio.sleep(0.25)
+        job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o expirado")
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_queue.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o expirado")
+    return job
+
 async def get_healthier_alternatives(categories_tags, current_barcode, original_name=None):
     """Find products in the same category with better Nutri-Score, ensuring relevance"""
     print(f"DEBUG ALTS: Searching for alternatives. Product: {original_name}, Categories: {categories_tags}")
@@ -535,7 +1331,7 @@ async def get_healthier_alternatives(categories_tags, current_barcode, original_
             continue
 
         url = f"https://world.openfoodfacts.org/cgi/search.pl?action=process&tagtype_0=categories&tag_contains_0=contains&tag_0={cat}&tagtype_1=nutrition_grades&tag_contains_1=contains&tag_1=A&json=true&page_size=30&sort_by=unique_scans_n"
-        headers = {"User-Agent": "FoodGuard/1.0 (aleco121@example.com) - Python/httpx"}
+        headers = OFF_HEADERS
         
         try:
             print(f"DEBUG ALTS: Trying category {cat}...")
@@ -601,259 +1397,1030 @@ async def get_healthier_alternatives(categories_tags, current_barcode, original_
     print("DEBUG ALTS: Finished searching all categories with 0 results.")
     return []
 
-# Analysis Core
-@app.post("/analyze", response_model=AnalysisResponse)
-async def analyze_product(request: AnalysisRequest):
-    url = f"https://world.openfoodfacts.org/api/v0/product/{request.barcode}.json"
-    headers = {"User-Agent": "FoodGuard/1.0 (aleco121@example.com) - Python/httpx"}
-    
-    data = None
-    async with httpx.AsyncClient(timeout=15.0) as client:
+# Product & Alternatives Cache (Prefetch + Warm-up)
+OFF_HEADERS = {"User-Agent": "FoodGuard/1.0 (aleco121@example.com) - Python/httpx"}
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 6 * 3600))
+ALTERNATIVES_CACHE_TTL = int(os.getenv("ALTERNATIVES_CACHE_TTL", 6 * 3600))
+ALTERNATIVES_EMPTY_TTL = int(os.getenv("ALTERNATIVES_EMPTY_TTL", 120))  # Empty may just mean OFF failed
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", 50))
+WARMUP_INTERVAL = int(os.getenv("WARMUP_INTERVAL_SECONDS", 1800))
+
+_alternatives_tasks: Dict[str, asyncio.Task] = {}  # barcode -> in-flight search (per worker)
+
+async def fetch_off_product(barcode: str):
+    """Fetch the raw OpenFoodFacts payload for a barcode, shared across workers when warm."""
+    return await cached_compute(
+        f"off:product:{barcode}", PRODUCT_CACHE_TTL,
+        lambda: _fetch_off_product_remote(barcode),
+        cacheable=lambda d: bool(d) and d.get("status") != 0
+    )
+
+# Latency-aware OpenFoodFacts fetching: adaptive timeouts from observed p95, a hedged request
+# to a mirror host once the primary passes that mark, and jittered exponential backoff between
+# attempts. OFF_FETCH_DEADLINE bounds the whole fetch regardless of retries.
+OFF_PRIMARY_HOST = os.getenv("OFF_PRIMARY_HOST", "https://world.openfoodfacts.org")
+OFF_MIRROR_HOST = os.getenv("OFF_MIRROR_HOST", "https://es.openfoodfacts.org")
+OFF_FETCH_DEADLINE = float(os.getenv("OFF_FETCH_DEADLINE", 12))
+OFF_MIN_TIMEOUT, OFF_MAX_TIMEOUT = 2.0, 8.0
+OFF_MIN_HEDGE_DELAY = 0.25
+
+class LatencyTracker:
+    """Rolling window of upstream latencies (seconds) for one worker. A timed-out request counts
+    as a sample of the timeout it used, and consecutive timeouts widen the next timeout, so a
+    slowdown past the current timeout raises it instead of failing every request."""
+
+    def __init__(self, size: int = 200, default_p95: float = 1.5, min_samples: int = 10):
+        self.samples = deque(maxlen=size)
+        self.default_p95 = default_p95
+        self.min_samples = min_samples
+        self.consecutive_timeouts = 0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.consecutive_timeouts = 0
+
+    def observe_timeout(self, timeout: float):
+        self.samples.append(timeout)
+        self.consecutive_timeouts += 1
+
+    def p95(self) -> float:
+        if len(self.samples) < self.min_samples: return self.default_p95
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def timeout(self) -> float:
+        widen = 2 ** min(self.consecutive_timeouts, 3)
+        return min(max(self.p95() * 3, OFF_MIN_TIMEOUT) * widen, OFF_MAX_TIMEOUT)
+
+    def hedge_delay(self) -> float:
+        return min(max(self.p95(), OFF_MIN_HEDGE_DELAY), self.timeout())
+
+off_latency = LatencyTracker()
+
+async def _off_get(client: httpx.AsyncClient, host: str, barcode: str, timeout: float):
+    """Single product request; None for a non-200 answer."""
+    start = time.monotonic()
+    try:
+        # httpx applies `timeout` per phase; wait_for bounds the whole request
+        response = await asyncio.wait_for(client.get(f"{host}/api/v0/product/{barcode}.json", headers=OFF_HEADERS, timeout=timeout), timeout)
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        off_latency.observe_timeout(timeout)
+        raise
+    if response.status_code != 200:
+        print(f"DEBUG: {host} answered {response.status_code} for {barcode}")
+        return None
+    off_latency.observe(time.monotonic() - start)
+    return response.json()
+
+async def _hedged_off_get(client: httpx.AsyncClient, barcode: str, timeout: float):
+    """Ask the primary host; if it has not answered by the p95 mark, also ask the mirror.
+    The first usable answer wins and the other request is cancelled."""
+    hosts = [OFF_PRIMARY_HOST] + ([OFF_MIRROR_HOST] if OFF_MIRROR_HOST and OFF_MIRROR_HOST != OFF_PRIMARY_HOST else [])
+    attempt_end = time.monotonic() + timeout
+    tasks = [asyncio.create_task(_off_get(client, hosts[0], barcode, timeout))]
+    pending = set(tasks)
+    last_error = None
+    try:
+        done, pending = await asyncio.wait(pending, timeout=off_latency.hedge_delay())
+        while True:
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                elif task.result() is not None:
+                    return task.result()
+            # Hedge when the primary is slow, or straight away if it already failed
+            if len(tasks) < len(hosts):
+                print(f"DEBUG: Hedging {barcode} to {hosts[len(tasks)]}")
+                # The hedge shares the attempt's time budget instead of starting a fresh timeout
+                hedge_timeout = max(attempt_end - time.monotonic(), 0.1)
+                hedge = asyncio.create_task(_off_get(client, hosts[len(tasks)], barcode, hedge_timeout))
+                tasks.append(hedge)
+                pending.add(hedge)
+            if not pending: break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            if not task.done(): task.cancel()
+    if last_error is not None and all(t.exception() is not None for t in tasks if t.done() and not t.cancelled()):
+        raise last_error
+    return None
+
+async def _fetch_off_product_remote(barcode: str):
+    deadline = time.monotonic() + OFF_FETCH_DEADLINE
+    last_error = None
+    async with httpx.AsyncClient() as client:
         for attempt in range(3): # Try up to 3 times
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.5: break
             try:
-                print(f"DEBUG: Attempting analysis for barcode {request.barcode} (Attempt {attempt+1})")
-                response = await client.get(url, headers=headers)
-                if response.status_code == 200:
-                    data = response.json()
-                    break
+                print(f"DEBUG: Attempting analysis for barcode {barcode} (Attempt {attempt+1}, p95 {off_latency.p95():.2f}s)")
+                timeout = min(off_latency.timeout(), remaining)
+                data = await asyncio.wait_for(_hedged_off_get(client, barcode, timeout), remaining)
+                if data is not None: return data
+                last_error = None  # Upstream answered, just not with a product
             except Exception as e:
                 print(f"DEBUG: Request failed: {str(e)}")
-                if attempt == 2: raise HTTPException(status_code=504, detail="Error de conexión con el servidor de alimentos")
-                await asyncio.sleep(1) # Wait before retry
+                last_error = e
+            backoff = min(0.25 * 2 ** attempt, 2.0) * random.uniform(0.5, 1.5)
+            if time.monotonic() + backoff >= deadline: break
+            await asyncio.sleep(backoff)
+    if last_error is not None:
+        raise HTTPException(status_code=504, detail="Error de conexión con el servidor de alimentos")
+    return None
+
+def prefetch_alternatives(barcode: str, categories_tags, product_name=None):
+    """Start the alternatives search in the background so /alternatives finds it ready or in flight."""
+    if not categories_tags or barcode in _alternatives_tasks: return
+    if shared_cache.get(f"off:alternatives:{barcode}") is not None: return
+
+    async def _search():
+        alts = await get_healthier_alternatives(categories_tags, barcode, product_name)
+        return jsonable_encoder(alts)
+
+    async def _run():
+        try:
+            ttl = lambda alts: ALTERNATIVES_CACHE_TTL if alts else ALTERNATIVES_EMPTY_TTL
+            return await cached_compute(f"off:alternatives:{barcode}", ttl, _search, lease_ttl=60)
+        finally:
+            _alternatives_tasks.pop(barcode, None)
+
+    print(f"DEBUG ALTS: Prefetching alternatives for {barcode}")
+    _alternatives_tasks[barcode] = asyncio.create_task(_run())
+
+async def get_alternatives_cached(barcode: str, categories_tags, product_name=None):
+    cached = shared_cache.get(f"off:alternatives:{barcode}")
+    if cached is not None:
+        print(f"DEBUG CACHE: Alternatives hit for {barcode}")
+        return cached
+    prefetch_alternatives(barcode, categories_tags, product_name)
+    task = _alternatives_tasks.get(barcode)
+    if not task: return []
+    # Shield so a client disconnect does not cancel the shared search
+    return await asyncio.shield(task)
+
+def db_get_top_barcodes(limit: int):
+    try:
+        ranked = db_rollup_top("barcode", limit)
+        if ranked: return [dim for dim, _ in ranked]
+    except Exception as e:
+        print(f"WARNING Warm-up: Rollups unavailable, ranking from history: {str(e)}")
+    if supabase:
+        res = supabase.table("history").select("barcode").order("timestamp", desc=True).limit(5000).execute()
+        counts = Counter(r["barcode"] for r in res.data if r.get("barcode"))
+        return [b for b, _ in counts.most_common(limit)]
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT barcode, COUNT(*) AS n FROM history WHERE barcode IS NOT NULL GROUP BY barcode ORDER BY n DESC LIMIT ?", (limit,))
+        rows = cursor.fetchall(); conn.close()
+        return [r[0] for r in rows]
 
-        if not data or data.get("status") == 0:
-            return AnalysisResponse(status="ERROR", product_name="No encontrado", image_url=None, matches=[], ingredients="", score=0, nutrients={}, nutriments={}, additives=[])
-        
-        product = data.get("product", {}) # Renamed to p_data in instruction, but keeping original for consistency with existing code
-        print(f"DEBUG: Processing product: {product.get('product_name', 'Unknown')}")
-        print(f"DEBUG: Raw Additives Tags: {product.get('additives_tags', [])}")
-        print(f"DEBUG: Raw Ingredients Text: {product.get('ingredients_text', 'NOT FOUND')}")
+async def warmup_popular_products():
+    """Preload product and alternatives data for the most-scanned barcodes."""
+    try:
+        barcodes = await asyncio.to_thread(db_get_top_barcodes, WARMUP_TOP_N)
+    except Exception as e:
+        print(f"WARNING Warm-up: Could not read popular barcodes: {str(e)}")
+        return
+    print(f"DEBUG Warm-up: Preloading {len(barcodes)} popular products")
+    for barcode in barcodes:
+        try:
+            data = await fetch_off_product(barcode)
+            if not data or data.get("status") == 0: continue
+            product = data.get("product", {})
+            product_name = product.get("product_name", product.get("product_name_es", "Desconocido"))
+            await get_alternatives_cached(barcode, product.get("categories_tags", []), product_name)
+        except Exception as e:
+            print(f"WARNING Warm-up: {barcode} failed: {str(e)}")
+
+async def warmup_loop():
+    while True:
+        # Only one worker per container runs each warm-up round
+        if shared_cache.add("lease:warmup", os.getpid(), max(WARMUP_INTERVAL - 5, 5)):
+            await warmup_popular_products()
+        await asyncio.sleep(WARMUP_INTERVAL)
+
+@app.on_event("startup")
+async def start_warmup():
+    if WARMUP_TOP_N > 0:
+        app.state.warmup_task = asyncio.create_task(warmup_loop())
+
+# Scoring Rules (shared by /analyze and the history re-scoring job)
+SCORING_VERSION = 1  # Bump whenever a penalty or threshold below changes
+NUTRIENT_KEYS = ("sugars_100g", "salt_100g", "fat_100g", "fiber_100g", "proteins_100g")
+
+RISK_DICTS = {
+    "gluten": ["trigo", "cebada", "centeno", "avena", "espelta", "malta", "gluten"],
+    "lactose": ["leche", "suero", "caseina", "nata", "mantequilla", "queso", "lactosa", "lácteos"],
+    "sugar": ["azúcar", "jarabe", "dextrosa", "fructosa", "melaza", "sacarosa"],
+    "nuts": ["cacahuete", "almendra", "avellana", "nuez", "anacardo", "pistacho", "frutos de cáscara"],
+    "palm_oil": ["palma", "palmiste"],
+    "vegetarian": ["carne", "pollo", "cerdo", "ternera", "pescado", "marisco", "gelatina", "grasas animales"],
+    "vegan": ["carne", "pollo", "cerdo", "ternera", "pescado", "marisco", "gelatina", "huevo", "leche", "miel", "queso", "mantequilla"],
+    "msg": ["glutamato", "e621", "e-621", "msg", "monosodium glutamate", "potenciador del sabor"]
+}
+RISK_LABELS = {
+    "gluten": "Gluten", "lactose": "Lactosa", "sugar": "Azúcar",
+    "nuts": "Frutos Secos", "palm_oil": "Aceite de Palma",
+    "vegetarian": "No Vegetariano", "vegan": "No Vegano", "msg": "Glutamato"
+}
 
-        product_name = product.get("product_name", product.get("product_name_es", "Desconocido"))
-        image_url = product.get("image_front_url")
-        
-        # Try multiple keys for ingredients
-        ingredients_text = product.get("ingredients_text_es") or product.get("ingredients_text") or product.get("ingredients_text_en") or ""
-        ingredients_text = ingredients_text.lower()
-        
-        # 2. Scoring Logic (Simulated Nutri-Score 0-100)
-        # Based on energy, sugars, salt, saturated fat + bonus for fiber/protein
-        score = 80 # Initial base
-        nutriments = product.get("nutriments", {})
-        levels = product.get("nutrient_levels", {})
-        sugars = nutriments.get("sugars_100g", 0)
-        salt = nutriments.get("salt_100g", 0)
-        fat = nutriments.get("fat_100g", 0)
-        fiber = nutriments.get("fiber_100g", 0)
-        protein = nutriments.get("proteins_100g", 0)
-        
-        # Penalties
-        if sugars > 12: score -= 20
-        if salt > 1.2: score -= 20
-        if fat > 18: score -= 15
-        
-        # Positive Rewards
-        if sugars < 2 and salt < 0.4: score += 10
-        if fiber > 5: score += 5
-        if protein > 10: score += 5
-        
-        # Update levels for frontend grid
-        levels["fiber"] = "high" if fiber > 4 else "low"
-        levels["proteins"] = "high" if protein > 10 else "low"
+def scoring_rules_version() -> str:
+    """Key for anything derived from scores: changes with the rules or the additive catalog."""
+    return f"{SCORING_VERSION}:{get_catalog().version}"
 
-        # 3. Additives (Super-Aggressive Detection System)
-        found_additives = []
-        found_codes = set()
+def _nutrient(nutriments: dict, key: str) -> float:
+    try:
+        return float(nutriments.get(key) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def nutrient_matrix(nutriments_list) -> np.ndarray:
+    """One row per product, columns in NUTRIENT_KEYS order."""
+    return np.array([[_nutrient(n, k) for k in NUTRIENT_KEYS] for n in nutriments_list], dtype=float).reshape(-1, len(NUTRIENT_KEYS))
+
+def score_products(nutrients: np.ndarray, penalties, has_danger, has_warning) -> np.ndarray:
+    """Simulated Nutri-Score 0-100, evaluated for many products at once.
+    Based on sugars, salt and fat + bonus for fiber/protein, minus additive penalties."""
+    sugars, salt, fat, fiber, protein = nutrients.T
+    score = np.full(len(nutrients), 80.0)  # Initial base
+
+    # Penalties
+    score -= 20 * (sugars > 12)
+    score -= 20 * (salt > 1.2)
+    score -= 15 * (fat > 18)
+
+    # Positive Rewards
+    score += 10 * ((sugars < 2) & (salt < 0.4))
+    score += 5 * (fiber > 5)
+    score += 5 * (protein > 10)
+
+    # Additive penalties and caps (Stricter Yuka-Plus Logic)
+    score -= np.asarray(penalties, dtype=float)
+    score = np.where(has_danger, np.minimum(score, 44), np.where(has_warning, np.minimum(score, 74), score))
+    return np.clip(score, 5, 100).astype(int)
+
+def get_ingredients_text(product: dict) -> str:
+    # Try multiple keys for ingredients
+    text = product.get("ingredients_text_es") or product.get("ingredients_text") or product.get("ingredients_text_en") or ""
+    return text.lower()
+
+def detect_additives(product: dict, ingredients_text: str, catalog: AdditiveCatalog):
+    """Additives (Super-Aggressive Detection System). Returns (found_additives, found_codes)."""
+    found_additives = []
+    found_codes = set()  # Upper-cased, as code lookups are case-insensitive ("E420I" is the E420i entry)
+
+    def add(code, detail):
+        additive = {"code": code, **detail}
+        if additive["code"].upper() not in found_codes:
+            found_additives.append(additive)
+            found_codes.add(additive["code"].upper())
+    
+    tags = product.get("additives_tags", [])
+    for tag in tags:
+        code = tag.split(":")[-1].upper()
+        if code not in found_codes:
+            add(code, catalog.by_code(code) or catalog.fallback(code))
+
+    # Priority 2: Full-Name and Synonym Matching (Crucial for Spanish market)
+    if ingredients_text:
+        text_clean = ingredients_text.lower()
+        for name_key, info in catalog.aliases():
+            if info["code"].upper() not in found_codes:
+                if name_key in text_clean:
+                    add(info["code"], info)
         
-        tags = product.get("additives_tags", [])
-        for tag in tags:
-            code = tag.split(":")[-1].upper()
+        # Priority 3: Regex Fallback for E-Codes (E123, E-123, e 123)
+        extra_codes = re.findall(r'[eE][-\s]?(\d{3,4}[a-z]?)', text_clean)
+        for num in extra_codes:
+            code_raw = num.upper()
+            code = f"E{code_raw}"
             if code not in found_codes:
-                detail = ADDITIVES_DB.get(code) or get_fallback_detail(code)
-                found_additives.append({"code": code, **detail})
-                found_codes.add(code)
-
-        # Priority 2: Full-Name and Synonym Matching (Crucial for Spanish market)
-        if ingredients_text:
-            text_clean = ingredients_text.lower()
-            for name_key, info in ADDITIVES_DICT.items():
-                code = info["code"]
-                if code not in found_codes:
-                    if name_key in text_clean:
-                        found_additives.append(info)
-                        found_codes.add(code)
+                detail = catalog.by_code(code) or catalog.by_code(f"E-{code_raw}")
+                if not detail: detail = catalog.fallback(code)
+                add(code, detail)
+
+    # Super-aggressive Aroma detection
+    text_clean = ingredients_text.lower()
+    if "aroma" in text_clean or "aromatizante" in text_clean:
+        if "AROMA" not in found_codes:
+            add("AROMA", catalog.by_alias("aroma"))
+    return found_additives, found_codes
+
+def additive_penalty(found_additives) -> tuple:
+    """Returns (penalty, has_danger, has_warning)."""
+    penalty = 0
+    has_danger = False
+    has_warning = False
+    for a in found_additives:
+        if a["safety"] == "danger":
+            penalty += 40 
+            has_danger = True
+        elif a["safety"] == "warning":
+            penalty += 20 
+            has_warning = True
+    return penalty, has_danger, has_warning
+
+def find_filter_matches(ingredients_text: str, nutriments: dict, found_codes, settings: dict) -> List[str]:
+    """Filters Match (Improved Robustness) for the user's dietary settings."""
+    found_matches = []
+    if ingredients_text:
+        for key, items in RISK_DICTS.items():
+            is_active = (
+                settings.get(f"{key}_free") or 
+                settings.get(f"no_{key}") or 
+                settings.get(f"low_{key}") or 
+                settings.get(key)
+            )
             
-            # Priority 3: Regex Fallback for E-Codes (E123, E-123, e 123)
-            extra_codes = re.findall(r'[eE][-\s]?(\d{3,4}[a-z]?)', text_clean)
-            for num in extra_codes:
-                code_raw = num.upper()
-                code = f"E{code_raw}"
-                if code not in found_codes:
-                    detail = ADDITIVES_DB.get(code) or ADDITIVES_DB.get(f"E-{code_raw}")
-                    if not detail: detail = get_fallback_detail(code)
-                    found_additives.append({"code": code, **detail})
-                    found_codes.add(code)
-
-        # 3.1 ADDITIVE PENALTIES (Stricter Yuka-Plus Logic)
-        additive_penalty = 0
-        has_danger = False
-        has_warning = False
-        
-        # Super-aggressive Aroma detection
-        text_clean = ingredients_text.lower()
-        if "aroma" in text_clean or "aromatizante" in text_clean:
-            if "AROMA" not in found_codes:
-                aroma_info = ADDITIVES_DICT.get("aroma")
-                found_additives.append({"code": "AROMA", **aroma_info})
-                found_codes.add("AROMA")
-
-        for a in found_additives:
-            if a["safety"] == "danger":
-                additive_penalty += 40 
-                has_danger = True
-            elif a["safety"] == "warning":
-                additive_penalty += 20 
-                has_warning = True
-        
-        score -= additive_penalty
-        if has_danger: score = min(score, 44) 
-        elif has_warning: score = min(score, 74) 
-        if score < 5: score = 5
-        if score > 100: score = 100
-
-        # 4. Filters Match (Improved Robustness)
-        RISK_DICTS = {
-            "gluten": ["trigo", "cebada", "centeno", "avena", "espelta", "malta", "gluten"],
-            "lactose": ["leche", "suero", "caseina", "nata", "mantequilla", "queso", "lactosa", "lácteos"],
-            "sugar": ["azúcar", "jarabe", "dextrosa", "fructosa", "melaza", "sacarosa"],
-            "nuts": ["cacahuete", "almendra", "avellana", "nuez", "anacardo", "pistacho", "frutos de cáscara"],
-            "palm_oil": ["palma", "palmiste"],
-            "vegetarian": ["carne", "pollo", "cerdo", "ternera", "pescado", "marisco", "gelatina", "grasas animales"],
-            "vegan": ["carne", "pollo", "cerdo", "ternera", "pescado", "marisco", "gelatina", "huevo", "leche", "miel", "queso", "mantequilla"],
-            "msg": ["glutamato", "e621", "e-621", "msg", "monosodium glutamate", "potenciador del sabor"]
-        }
-        
-        found_matches = []
-        if ingredients_text:
-            for key, items in RISK_DICTS.items():
-                is_active = (
-                    request.settings.get(f"{key}_free") or 
-                    request.settings.get(f"no_{key}") or 
-                    request.settings.get(f"low_{key}") or 
-                    request.settings.get(key)
-                )
+            if is_active:
+                for item in items:
+                    if item in ingredients_text:
+                        if key == "gluten" and "trigo sarraceno" in ingredients_text and item == "trigo": continue
+                        found_matches.append(f"{RISK_LABELS.get(key, key.capitalize())}: Detectado '{item}'")
+                        break
                 
-                if is_active:
-                    for item in items:
-                        if item in ingredients_text:
-                            if key == "gluten" and "trigo sarraceno" in ingredients_text and item == "trigo": continue
-                            # Improved description
-                            label = {
-                                "gluten": "Gluten", "lactose": "Lactosa", "sugar": "Azúcar",
-                                "nuts": "Frutos Secos", "palm_oil": "Aceite de Palma",
-                                "vegetarian": "No Vegetariano", "vegan": "No Vegano", "msg": "Glutamato"
-                            }.get(key, key.capitalize())
-                            found_matches.append(f"{label}: Detectado '{item}'")
-                            break
-                    
-                    if key == "msg" and "E621" in found_codes and not any("MSG" in m for m in found_matches):
-                        found_matches.append("MSG: Detectado Aditivo E621")
-                    elif key == "lactose" and any(c in found_codes for c in ["E966"]) and not any("Lactosa" in m for m in found_matches):
-                        found_matches.append("Lactosa: Detectado Aditivo E966")
-
-        # Nutrient-based Alerts (Numerical)
-        if request.settings.get("low_fat") or request.settings.get("no_fat"):
-            fat_val = nutriments.get("fat_100g", 0)
-            if fat_val > 17.5: # Standard high fat threshold
-                found_matches.append(f"Grasas: Nivel muy alto ({fat_val}g/100g)")
-        
-        if request.settings.get("low_sugar") and not any("Azúcar" in m for m in found_matches):
-            sugar_val = nutriments.get("sugars_100g", 0)
-            if sugar_val > 22.5: # Standard high sugar threshold
-                found_matches.append(f"Azúcar: Nivel muy alto ({sugar_val}g/100g)")
-        
-        status_res = "WARNING" if found_matches or score < 40 else "SAFE"
-        
-        if request.username:
-            print(f"DEBUG: Inserting history for user {request.username}, product {product_name}")
-            db_save_history(request.username, request.barcode, product_name, status_res, score)
+                if key == "msg" and "E621" in found_codes and not any("MSG" in m for m in found_matches):
+                    found_matches.append("MSG: Detectado Aditivo E621")
+                elif key == "lactose" and any(c in found_codes for c in ["E966"]) and not any("Lactosa" in m for m in found_matches):
+                    found_matches.append("Lactosa: Detectado Aditivo E966")
+
+    # Nutrient-based Alerts (Numerical)
+    if settings.get("low_fat") or settings.get("no_fat"):
+        fat_val = nutriments.get("fat_100g", 0)
+        if _nutrient(nutriments, "fat_100g") > 17.5: # Standard high fat threshold
+            found_matches.append(f"Grasas: Nivel muy alto ({fat_val}g/100g)")
+    
+    if settings.get("low_sugar") and not any("Azúcar" in m for m in found_matches):
+        sugar_val = nutriments.get("sugars_100g", 0)
+        if _nutrient(nutriments, "sugars_100g") > 22.5: # Standard high sugar threshold
+            found_matches.append(f"Azúcar: Nivel muy alto ({sugar_val}g/100g)")
+    return found_matches
 
-        # 5. Return basic data (Alternatives will be lazy-loaded)
-        categories = product.get("categories_tags", [])
-        
-        return AnalysisResponse(
-            status=status_res, product_name=product_name, image_url=image_url,
-            barcode=request.barcode,
-            matches=found_matches, ingredients=ingredients_text or "No disponible.",
-            score=int(score), nutrients=levels, nutriments=nutriments, additives=found_additives,
-            categories=categories,
-            alternatives=[]
-        )
+def compute_status(found_matches: List[str], score: int) -> str:
+    return "WARNING" if found_matches or score < 40 else "SAFE"
+
+# Analysis Core
+# Analyses are pure functions of (barcode, settings, scoring rules), so each worker keeps recent ones
+# with their encoded bodies; a repeat scan only records history and serves the stored bytes.
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 300))
+ANALYSIS_CACHE_ENTRIES = int(os.getenv("ANALYSIS_CACHE_ENTRIES", 512))
+_analysis_cache: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, Analysis)
+
+class Analysis:
+    """A computed AnalysisResponse, its encoded payload and the additive codes found."""
+    __slots__ = ("response", "payload", "codes")
+
+    def __init__(self, response: AnalysisResponse, codes=()):
+        self.response = response
+        self.payload = EncodedPayload.from_model(response)
+        self.codes = codes
+
+async def compute_analysis(barcode: str, settings: dict) -> Analysis:
+    data = await fetch_off_product(barcode)
+
+    if not data or data.get("status") == 0:
+        return Analysis(AnalysisResponse(status="ERROR", product_name="No encontrado", image_url=None, matches=[], ingredients="", score=0, nutrients={}, nutriments={}, additives=[]))
+    
+    product = data.get("product", {}) # Renamed to p_data in instruction, but keeping original for consistency with existing code
+    print(f"DEBUG: Processing product: {product.get('product_name', 'Unknown')}")
+    print(f"DEBUG: Raw Additives Tags: {product.get('additives_tags', [])}")
+    print(f"DEBUG: Raw Ingredients Text: {product.get('ingredients_text', 'NOT FOUND')}")
+
+    product_name = product.get("product_name", product.get("product_name_es", "Desconocido"))
+    image_url = product.get("image_front_url")
+    
+    ingredients_text = get_ingredients_text(product)
+    nutriments = product.get("nutriments", {})
+    levels = dict(product.get("nutrient_levels", {}))  # Copy: product may be a cached payload
+    fiber = _nutrient(nutriments, "fiber_100g")
+    protein = _nutrient(nutriments, "proteins_100g")
+    
+    # Update levels for frontend grid
+    levels["fiber"] = "high" if fiber > 4 else "low"
+    levels["proteins"] = "high" if protein > 10 else "low"
+
+    # 2-3. Nutrient score, additive detection and penalties
+    catalog = get_catalog()  # One consistent catalog version for the whole analysis
+    found_additives, found_codes = detect_additives(product, ingredients_text, catalog)
+    penalty, has_danger, has_warning = additive_penalty(found_additives)
+    score = int(score_products(nutrient_matrix([nutriments]), [penalty], [has_danger], [has_warning])[0])
+
+    # 4. Filters Match
+    found_matches = find_filter_matches(ingredients_text, nutriments, found_codes, settings)
+    status_res = compute_status(found_matches, score)
+
+    # 5. Basic data (Alternatives are prefetched in background and served by /alternatives)
+    return Analysis(AnalysisResponse(
+        status=status_res, product_name=product_name, image_url=image_url,
+        barcode=barcode,
+        matches=found_matches, ingredients=ingredients_text or "No disponible.",
+        score=int(score), nutrients=levels, nutriments=nutriments, additives=found_additives,
+        categories=product.get("categories_tags", []),
+        alternatives=[]
+    ), sorted(found_codes))
+
+async def get_analysis(barcode: str, settings: dict) -> Analysis:
+    settings_key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+    key = f"{barcode}:{settings_key}:{scoring_rules_version()}"
+    hit = _analysis_cache.get(key)
+    if hit and hit[0] > time.time():
+        _analysis_cache.move_to_end(key)
+        return hit[1]
+    analysis = await compute_analysis(barcode, settings)
+    if analysis.response.status != "ERROR":  # Lookup failures may be transient
+        _analysis_cache[key] = (time.time() + ANALYSIS_CACHE_TTL, analysis)
+        _analysis_cache.move_to_end(key)
+        while len(_analysis_cache) > ANALYSIS_CACHE_ENTRIES:
+            _analysis_cache.popitem(last=False)
+    return analysis
+
+async def run_analysis(request: AnalysisRequest) -> Analysis:
+    """Analyze a scan and apply its side effects: history (when logged in) and alternatives prefetch."""
+    analysis = await get_analysis(request.barcode, request.settings)
+    result = analysis.response
+    if result.status == "ERROR": return analysis
+    
+    if request.username:
+        print(f"DEBUG: Inserting history for user {request.username}, product {result.product_name}")
+        db_save_history(request.username, request.barcode, result.product_name, result.status, result.score, analysis.codes)
+
+    prefetch_alternatives(request.barcode, result.categories, result.product_name)
+    return analysis
+
+@app.post("/analyze", response_model=AnalysisResponse)
+async def analyze_product(request: AnalysisRequest, http_request: Request):
+    analysis = await run_analysis(request)
+    return encoded_response(http_request, payload=analysis.payload)
 
 @app.post("/alternatives", response_model=List[Alternative])
-async def get_alternatives_endpoint(request: AlternativesRequest):
+async def get_alternatives_endpoint(request: AlternativesRequest, http_request: Request):
     print(f"DEBUG: Lazy loading alternatives for {request.barcode} ({request.product_name})")
-    return await get_healthier_alternatives(request.categories, request.barcode, request.product_name)
+    return encoded_response(http_request, await get_alternatives_cached(request.barcode, request.categories, request.product_name))
         
-def get_fallback_detail(code):
-    """Deep Clinical Fallback for missing E-codes based on institutional risk ranges with detailed contexts."""
-    code = code.upper()
+# Admin Access
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not secrets.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Acceso de administrador requerido")
+
+# History Re-scoring
+# Streams the history table by id, scores each product once per run (vectorized nutrient rules),
+# derives every row's status from its user's current settings and writes changes back in one
+# transaction per chunk. Progress is checkpointed in the app_state table, so a stopped or crashed
+# run resumes from the last committed chunk; a rules/catalog change restarts it from the top.
+# A stop request is its own app_state row, so the runner's checkpoints never overwrite it.
+RESCORE_CHUNK_SIZE = int(os.getenv("RESCORE_CHUNK_SIZE", 500))
+RESCORE_FETCHES_PER_SECOND = float(os.getenv("RESCORE_FETCHES_PER_SECOND", 2))
+RESCORE_CHUNK_PAUSE = float(os.getenv("RESCORE_CHUNK_PAUSE", 0.5))
+RESCORE_PRODUCT_MEMORY = 5000  # Scored products kept for the rest of the run
+RESCORE_STATE_KEY = "rescore"
+RESCORE_STOP_KEY = "rescore:stop"
+RESCORE_LEASE_KEY = "lease:rescore"
+RESCORE_LEASE_TTL = 120
+RESCORE_CHECK_INTERVAL = 5  # Seconds between lease renewals / stop checks while fetching
+
+class RescoreInterrupted(Exception):
+    """Raised inside a run when it was asked to stop or lost its lease to another runner."""
+
+def db_get_app_state(name: str) -> Optional[dict]:
+    if supabase:
+        res = supabase.table("app_state").select("value").eq("name", name).execute()
+        return res.data[0]["value"] if res.data else None
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT value FROM app_state WHERE name=?", (name,))
+        row = cursor.fetchone(); conn.close()
+        return json.loads(row[0]) if row else None
+
+def db_set_app_state(name: str, value: dict):
+    if supabase:
+        supabase.table("app_state").upsert({"name": name, "value": value, "updated_at": time.time()}).execute()
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO app_state (name, value, updated_at) VALUES (?, ?, ?)", (name, json.dumps(value), time.time()))
+        conn.commit(); conn.close()
+
+def db_delete_app_state(name: str):
+    if supabase:
+        supabase.table("app_state").delete().eq("name", name).execute()
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("DELETE FROM app_state WHERE name=?", (name,))
+        conn.commit(); conn.close()
+
+def db_history_count() -> int:
+    if supabase:
+        res = supabase.table("history").select("id", count="exact").limit(1).execute()
+        return res.count or 0
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM history")
+        total = cursor.fetchone()[0]; conn.close()
+        return total
+
+def db_history_chunk(after_id: int, limit: int):
+    if supabase:
+        res = supabase.table("history").select("id, username, barcode, score, status, timestamp").gt("id", after_id).order("id").limit(limit).execute()
+        return [(r["id"], r["username"], r["barcode"], r["score"], r["status"], r["timestamp"]) for r in res.data]
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT id, username, barcode, score, status, timestamp FROM history WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+        rows = cursor.fetchall(); conn.close()
+        return rows
+
+def db_get_settings(usernames) -> Dict[str, dict]:
+    usernames = [u for u in set(usernames) if u]
+    if not usernames: return {}
+    if supabase:
+        res = supabase.table("users").select("username, settings").in_("username", usernames).execute()
+        rows = [(r["username"], r.get("settings")) for r in res.data]
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute(f"SELECT username, settings FROM users WHERE username IN ({','.join('?' * len(usernames))})", usernames)
+        rows = cursor.fetchall(); conn.close()
+    result = {}
+    for username, raw in rows:
+        try:
+            result[username] = (json.loads(raw) if isinstance(raw, str) else raw) or {}
+        except ValueError:
+            result[username] = {}
+    return result
+
+def db_update_scores(updates):
+    """updates: [(id, score, status, old_status, timestamp)], applied as one batch. Status changes
+    are moved between the status rollups too, so the per-day distribution keeps matching history."""
+    if not updates: return
+    if supabase:
+        supabase.table("history").upsert([{"id": i, "score": s, "status": st} for i, s, st, _, _ in updates]).execute()
+        # Rows that predate the rollups were never counted; without a pinned bound move nothing
+        state = db_get_app_state(ROLLUP_STATE_KEY)
+        bound = state["backfill_until"] if state else None
+        items = [item for i, _, st, old, ts in updates if bound is not None and i > bound
+                 for item in rollup_status_items(ts, old, st)]
+        if items:
+            try:
+                supabase.rpc("rollup_add", {"items": [dict(zip(ROLLUP_COLUMNS, i)) for i in items]}).execute()
+            except Exception as e:
+                print(f"WARNING Rollups: Could not move re-scored statuses: {str(e)}")
+    else:
+        conn = sqlite3.connect(DB_PATH, timeout=30); cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        # Rows the background backfill has yet to reach are counted with their new status by it
+        bound, done = _rollup_meta(cursor, "backfill_until"), _rollup_meta(cursor, "backfill_done")
+        cursor.executemany("UPDATE history SET score=?, status=? WHERE id=?", [(s, st, i) for i, s, st, _, _ in updates])
+        cursor.executemany(ROLLUP_UPSERT_SQL, [item for i, _, st, old, ts in updates if i <= done or i > bound
+                                               for item in rollup_status_items(ts, old, st)])
+        conn.commit(); conn.close()
+
+def get_rescore_state() -> Optional[dict]:
+    return db_get_app_state(RESCORE_STATE_KEY)
+
+def save_rescore_state(state: dict):
+    state["updated_at"] = time.time()
+    db_set_app_state(RESCORE_STATE_KEY, state)
+
+def rescore_heartbeat(token: str):
+    """Every RESCORE_CHECK_INTERVAL: renew this run's lease and honour stop requests."""
+    checked = {"at": time.monotonic()}
+
+    def beat():
+        if time.monotonic() - checked["at"] < RESCORE_CHECK_INTERVAL: return
+        if shared_cache.renew(RESCORE_LEASE_KEY, token, RESCORE_LEASE_TTL) is False:
+            raise RescoreInterrupted("lease lost")
+        if db_get_app_state(RESCORE_STOP_KEY):
+            raise RescoreInterrupted("stopped")
+        checked["at"] = time.monotonic()
+    return beat
+
+async def score_barcodes(barcodes, heartbeat=None) -> Dict[str, Optional[dict]]:
+    """Fetch and score a batch of products; nutrient rules are evaluated for the whole batch at once."""
+    catalog = get_catalog()
+    fetched = []
+    for barcode in barcodes:
+        was_cached = shared_cache.get(f"off:product:{barcode}") is not None
+        try:
+            data = await fetch_off_product(barcode)
+        except HTTPException:
+            data = None
+        if data and data.get("status") != 0:
+            fetched.append((barcode, data.get("product", {})))
+        if not was_cached:
+            await asyncio.sleep(1 / RESCORE_FETCHES_PER_SECOND)  # Be gentle with OpenFoodFacts
+        if heartbeat: heartbeat()  # A chunk of uncached products can outlive the lease TTL
+
+    results: Dict[str, Optional[dict]] = {b: None for b in barcodes}
+    if not fetched: return results
+    texts, codes, penalties, dangers, warnings = [], [], [], [], []
+    for _, product in fetched:
+        text = get_ingredients_text(product)
+        found_additives, found_codes = detect_additives(product, text, catalog)
+        penalty, has_danger, has_warning = additive_penalty(found_additives)
+        texts.append(text); codes.append(found_codes)
+        penalties.append(penalty); dangers.append(has_danger); warnings.append(has_warning)
+    nutriments = [p.get("nutriments", {}) for _, p in fetched]
+    scores = score_products(nutrient_matrix(nutriments), penalties, np.array(dangers), np.array(warnings))
+    for i, (barcode, _) in enumerate(fetched):
+        results[barcode] = {"score": int(scores[i]), "text": texts[i], "nutriments": nutriments[i], "codes": codes[i]}
+    return results
+
+def pause_rescore(state: dict):
+    db_delete_app_state(RESCORE_STOP_KEY)
+    state["status"] = "paused"
+    save_rescore_state(state)
+    print(f"DEBUG Rescore: Paused at id {state['last_id']}")
+
+async def run_rescore(token: str):
+    state = get_rescore_state()
+    products: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+    heartbeat = rescore_heartbeat(token)
+    print(f"DEBUG Rescore: Starting at id > {state['last_id']} (rules {state['rules_version']})")
     try:
-        match = re.search(r'\d+', code)
-        if not match: raise ValueError
-        num = int(match.group())
-    except:
-        return {"name": f"Aditivo {code}", "safety": "warning", "harm": "Sin datos específicos. Categoría bajo vigilancia clínica.", "harm_detail": "No se dispone de un informe clínico individual para este compuesto específico. Se recomienda precaución ante la falta de transparencia en su evaluación de seguridad a largo plazo.", "risk_profile": "🧪 Desconocido", "adi_warning": "⚠️ Consultar DDA", "study": "EFSA: En ciclo de re-evaluación.", "study_detail": "El aditivo se encuentra en la lista de sustancias pendientes de actualización técnica por parte de los paneles de seguridad alimentaria."}
-    
-    if 100 <= num <= 199:
-        return {
-            "name": f"Colorante {code}", "safety": "danger", 
-            "harm": "Colorante industrial. Riesgo de hiperactividad y reacciones alérgicas.", 
-            "harm_detail": "Los colorantes de este rango suelen ser azoicos o sintéticos, conocidos por inducir la liberación de histamina y alterar la barrera mucosa en niños sensibles. Pueden interferir con los neurotransmisores cerebrales.",
-            "risk_profile": "🧬 Alergénico / 🧠 Neuroconductual", "adi_warning": "⚠️ Evitar en niños", 
-            "study": "EFSA / Univ. Southampton: Asociación con trastornos de conducta infantil.",
-            "study_detail": "Múltiples metaanálisis confirman que la eliminación de colorantes artificiales mejora los síntomas de TDAH en un subgrupos significativo de la población infantil."
-        }
-    elif 200 <= num <= 299:
-        return {
-            "name": f"Conservante {code}", "safety": "danger", 
-            "harm": "Protección química contra microbios. Potencial daño al material genético celular.", 
-            "harm_detail": "Sustancias diseñadas para inhibir la vida microbiana que, en dosis acumulativas, pueden inducir estrés oxidativo y genotoxicidad en las células gástricas humanas.",
-            "risk_profile": "🧬 Genotoxicidad / 🧪 Químico", "adi_warning": "❌ Ingesta limitada", 
-            "study": "ANSES: Los conservantes químicos deben ser minimizados por su impacto acumulativo.",
-            "study_detail": "Informes institucionales alertan sobre el 'efecto cóctel': la interacción de varios conservantes en una misma dieta puede multiplicar su toxicidad individual."
-        }
-    elif 300 <= num <= 399:
-        if num > 337:
-             return {
-                 "name": f"Antioxidante/Fosfato {code}", "safety": "danger", 
-                 "harm": "Fosfatos industriales. Elevan el riesgo de daño cardiovascular y calcificación renal.", 
-                 "harm_detail": "El fósforo inorgánico se absorbe al 100%, elevando los niveles de la hormona FGF23, lo que daña las arterias y sobrecarga los riñones de forma crónica.",
-                 "risk_profile": "🫀 Vascular / 🚿 Renal", "adi_warning": "⚠️ Muy acumulativo", 
-                 "study": "BMJ (INSERM): Los fosfatos añadidos superan la DDA recomendada en UPFs.",
-                 "study_detail": "Estudios epidemiológicos vinculan el consumo elevado de fosfatos con una menor esperanza de vida debido a la calcificación vascular prematura."
-             }
-        return {"name": f"Antioxidante {code}", "safety": "safe", "harm": "Regulador de acidez o protección contra oxidación.", "harm_detail": "Antioxidantes generalmente derivados de fuentes naturales que ayudan a prevenir el enranciamiento sin efectos adversos conocidos en dosis estándar.", "risk_profile": "✅ Probable Seguro", "adi_warning": "✅ Seguro en dosis normales", "study": "EFSA: Evaluación tecnológica general.", "study_detail": "Evaluación favorable basada en la ausencia de bioacumulación y toxicidad aguda."}
-    elif 400 <= num <= 499:
-        return {
-            "name": f"Emulgente/Espesante {code}", "safety": "warning", 
-            "harm": "Agente de textura industrial. Altera la barrera de mucina y la microbiota intestinal.", 
-            "harm_detail": "Actúan como detergentes en el intestino, disolviendo la capa de moco que protege el epitelio y facilitando la traslocación bacteriana y la inflamación crónica.",
-            "risk_profile": "🦠 Microbiota / 🩹 Barrera Intestinal", "adi_warning": "⚠️ Marcador Ultraprocesado", 
-            "study": "Nature Immunology: Impacto en la inflamación intestinal crónica por detergentes alimentarios.",
-            "study_detail": "Se ha demostrado en modelos in vitro y animales que estos aditivos promueven la disbiosis y aumentan la susceptibilidad a enfermedades autoinmunes."
-        }
-    elif 600 <= num <= 699:
-        return {
-            "name": f"Potenciador {code}", "safety": "danger", 
-            "harm": "Excitotoxina química. Estimula artificialmente el apetito y puede causar migrañas.", 
-            "harm_detail": "Compuestos que sobreestimulan las papilas gustativas y los receptores neuronales, provocando una respuesta de placer artificial que anula las señales naturales de saciedad.",
-            "risk_profile": "🧠 Neurosensible / 🧪 Excitotóxico", "adi_warning": "⚠️ Evitar sensibilidad", 
-            "study": "JECFA: Evaluación sobre neuroexcitación y glutamatos.",
-            "study_detail": "La evidencia sugiere que personas con sensibilidad química pueden experimentar el 'síndrome del restaurante chino' incluso con dosis moderadas de estos potenciadores."
-        }
-    
-    return {"name": f"Aditivo {code}", "safety": "warning", "harm": "Aditivo industrial multifuncional. Consumo debe ser limitado.", "harm_detail": "Sustancia de uso industrial extendido para mejorar la palatabilidad o conservación. Se recomienda priorizar alimentos frescos sin estos marcadores de ultraprocesamiento.", "risk_profile": "🧪 Industrial", "adi_warning": "⚠️ Consultar DDA", "study": "EFSA: Bajo revisión técnica.", "study_detail": "Categorizado como ingrediente cosmético alimentario pendiente de estudios epidemiológicos a largo plazo."}
+        while True:
+            if db_get_app_state(RESCORE_STOP_KEY):
+                pause_rescore(state)
+                return
+
+            rows = await asyncio.to_thread(db_history_chunk, state["last_id"], RESCORE_CHUNK_SIZE)
+            if not rows:
+                state.update(status="done", finished_at=time.time())
+                save_rescore_state(state)
+                print(f"DEBUG Rescore: Done. {state['processed']} rows, {state['updated']} updated")
+                return
+
+            # Group by barcode so each product is fetched and scored once
+            missing = list(dict.fromkeys(r[2] for r in rows if r[2] and r[2] not in products))
+            for barcode, scored in (await score_barcodes(missing, heartbeat)).items():
+                products[barcode] = scored
+                while len(products) > RESCORE_PRODUCT_MEMORY:
+                    products.popitem(last=False)
+
+            settings = await asyncio.to_thread(db_get_settings, [r[1] for r in rows])
+            statuses: Dict[tuple, str] = {}
+            updates = []
+            for row_id, username, barcode, old_score, old_status, timestamp in rows:
+                scored = products.get(barcode)
+                if not scored: continue  # Product gone from OpenFoodFacts: keep the stored result
+                user_settings = settings.get(username, {})
+                key = (barcode, json.dumps(user_settings, sort_keys=True))
+                if key not in statuses:
+                    matches = find_filter_matches(scored["text"], scored["nutriments"], scored["codes"], user_settings)
+                    statuses[key] = compute_status(matches, scored["score"])
+                if (scored["score"], statuses[key]) != (old_score, old_status):
+                    updates.append((row_id, scored["score"], statuses[key], old_status, timestamp))
+
+            await asyncio.to_thread(db_update_scores, updates)
+            state["last_id"] = rows[-1][0]
+            state["processed"] += len(rows)
+            state["updated"] += len(updates)
+            state["products_scored"] += len(missing)
+            save_rescore_state(state)
+            shared_cache.renew(RESCORE_LEASE_KEY, token, RESCORE_LEASE_TTL)
+            print(f"DEBUG Rescore: {state['processed']}/{state['total']} rows, {state['updated']} updated")
+            await asyncio.sleep(RESCORE_CHUNK_PAUSE)
+    except RescoreInterrupted as e:
+        # The partial chunk is not checkpointed; a resumed run redoes it (its products are cached)
+        if str(e) == "stopped":
+            pause_rescore(state)
+        else:
+            print(f"WARNING Rescore: Lease taken over by another runner, stopping at id {state['last_id']}")
+    except Exception as e:
+        print(f"ERROR Rescore: {str(e)}")
+        traceback.print_exc()
+        state.update(status="error", error=str(e))
+        save_rescore_state(state)
+    finally:
+        shared_cache.release(RESCORE_LEASE_KEY, token)
+
+async def start_rescore(restart: bool = False) -> dict:
+    """Start or resume the re-scoring run in this worker, unless another worker already runs it."""
+    token = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if not shared_cache.add(RESCORE_LEASE_KEY, token, RESCORE_LEASE_TTL):
+        return get_rescore_state() or {}
+    db_delete_app_state(RESCORE_STOP_KEY)
+    rules_version = scoring_rules_version()
+    state = get_rescore_state()
+    if restart or not state or state.get("rules_version") != rules_version or state.get("status") == "done":
+        state = {"rules_version": rules_version, "last_id": 0, "processed": 0, "updated": 0,
+                 "products_scored": 0, "started_at": time.time()}
+    state.update(status="running", error=None, total=await asyncio.to_thread(db_history_count))
+    save_rescore_state(state)
+    app.state.rescore_task = asyncio.create_task(run_rescore(token))
+    return state
+
+@app.on_event("startup")
+async def resume_interrupted_rescore():
+    state = get_rescore_state()
+    if state and state.get("status") == "running":
+        if db_get_app_state(RESCORE_STOP_KEY):
+            pause_rescore(state)  # Stopped while no runner was alive
+        else:
+            await start_rescore()  # The lease decides which worker picks it up
+
+@app.post("/admin/rescore", dependencies=[Depends(require_admin)])
+async def admin_start_rescore(restart: bool = False):
+    return await start_rescore(restart)
+
+@app.get("/admin/rescore", dependencies=[Depends(require_admin)])
+async def admin_rescore_progress():
+    state = get_rescore_state()
+    if not state:
+        return {"status": "idle", "rules_version": scoring_rules_version()}
+    progress = round(100 * state["processed"] / state["total"], 1) if state.get("total") else None
+    if state.get("status") == "running" and db_get_app_state(RESCORE_STOP_KEY):
+        state["status"] = "stopping"
+    return {**state, "progress": progress, "current_rules_version": scoring_rules_version()}
+
+@app.delete("/admin/rescore", dependencies=[Depends(require_admin)])
+async def admin_stop_rescore():
+    state = get_rescore_state()
+    if not state or state.get("status") != "running":
+        return state or {"status": "idle"}
+    db_set_app_state(RESCORE_STOP_KEY, {"requested_at": time.time()})
+    return {**state, "status": "stopping"}
+
+# Analytics Compaction & Retention
+# A leased periodic job prunes hourly rollups past their window and clears the active-user sets of
+# closed buckets, once the history that predates the rollups has been backfilled into them. With
+# HISTORY_RETENTION_DAYS set, raw history older than that is folded into the per-user
+# history_archive (counts and score sums) and deleted; the rollups already hold its totals.
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv("ROLLUP_HOURLY_RETENTION_DAYS", 7))
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", 0))  # 0 = keep raw history forever
+COMPACTION_INTERVAL = int(os.getenv("COMPACTION_INTERVAL_SECONDS", 3600))
+ARCHIVE_CHUNK_SIZE = 1000
+ANALYTICS_MAX_DAYS = 90
+
+def db_compact_rollups(now: datetime):
+    hour_cutoff = (now - timedelta(days=ROLLUP_HOURLY_RETENTION_DAYS)).isoformat()[:13]
+    current = dict(rollup_buckets(now.isoformat()))
+    if supabase:
+        supabase.table("rollups").delete().eq("granularity", "hour").lt("bucket", hour_cutoff).execute()
+        for granularity in ("hour", "day"):
+            supabase.table("rollup_active_users").delete().eq("granularity", granularity).lt("bucket", current[granularity]).execute()
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("DELETE FROM rollups WHERE granularity='hour' AND bucket < ?", (hour_cutoff,))
+        for granularity in ("hour", "day"):
+            cursor.execute("DELETE FROM rollup_active_users WHERE granularity=? AND bucket < ?", (granularity, current[granularity]))
+        conn.commit(); conn.close()
+
+def _archive_totals(rows):
+    totals: Dict[str, dict] = {}
+    for _, username, score, status_val, timestamp in rows:
+        t = totals.setdefault(username, {"total": 0, "score_sum": 0, "safe": 0, "warning": 0, "danger": 0, "archived_until": ""})
+        t["total"] += 1
+        t["score_sum"] += score or 0
+        if status_val in ("SAFE", "WARNING", "DANGER"): t[status_val.lower()] += 1
+        t["archived_until"] = max(t["archived_until"], timestamp or "")
+    return totals
+
+def db_archive_history_chunk(cutoff: str) -> int:
+    """Fold one chunk of history older than cutoff into history_archive. Returns rows archived."""
+    columns = ("total", "score_sum", "safe", "warning", "danger")
+    if supabase:
+        res = supabase.table("history").select("id, username, score, status, timestamp").lt("timestamp", cutoff).order("id").limit(ARCHIVE_CHUNK_SIZE).execute()
+        rows = [(r["id"], r["username"], r["score"], r["status"], r["timestamp"]) for r in res.data]
+        if not rows: return 0
+        totals = _archive_totals(rows)
+        existing = supabase.table("history_archive").select("*").in_("username", list(totals)).execute()
+        for r in existing.data:
+            t = totals[r["username"]]
+            for c in columns: t[c] += r.get(c) or 0
+            t["archived_until"] = max(t["archived_until"], r.get("archived_until") or "")
+        supabase.table("history_archive").upsert([{"username": u, **t} for u, t in totals.items()]).execute()
+        supabase.table("history").delete().in_("id", [r[0] for r in rows]).execute()
+        return len(rows)
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT id, username, score, status, timestamp FROM history WHERE timestamp < ? ORDER BY id LIMIT ?", (cutoff, ARCHIVE_CHUNK_SIZE))
+        rows = cursor.fetchall()
+        if rows:
+            cursor.executemany(
+                "INSERT INTO history_archive (username, total, score_sum, safe, warning, danger, archived_until) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET total = total + excluded.total, score_sum = score_sum + excluded.score_sum, "
+                "safe = safe + excluded.safe, warning = warning + excluded.warning, danger = danger + excluded.danger, "
+                "archived_until = MAX(archived_until, excluded.archived_until)",
+                [(u, *(t[c] for c in columns), t["archived_until"]) for u, t in _archive_totals(rows).items()])
+            cursor.executemany("DELETE FROM history WHERE id=?", [(r[0],) for r in rows])
+            conn.commit()  # Archive and delete land together
+        conn.close()
+        return len(rows)
+
+def db_get_history_archive(username: str) -> Optional[dict]:
+    if supabase:
+        res = supabase.table("history_archive").select("*").eq("username", username).execute()
+        return res.data[0] if res.data else None
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT total, score_sum, safe, warning, danger FROM history_archive WHERE username=?", (username,))
+        row = cursor.fetchone(); conn.close()
+        return dict(zip(("total", "score_sum", "safe", "warning", "danger"), row)) if row else None
+
+async def backfill_rollups():
+    """Folds pre-rollup history in short transactions; live scans take the write lock in between."""
+    while True:
+        done, bound = await asyncio.to_thread(db_backfill_rollups_chunk)
+        if done >= bound: return
+        print(f"DEBUG Rollups: Backfilled history up to id {done}/{bound}")
+        await asyncio.sleep(0.05)
+
+async def compact_analytics():
+    now = datetime.now()
+    try:
+        # Pruning active-user sets or archiving history mid-backfill would skew its counts
+        await backfill_rollups()
+        await asyncio.to_thread(db_compact_rollups, now)
+        if HISTORY_RETENTION_DAYS > 0:
+            cutoff = (now - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+            archived = 0
+            while True:
+                n = await asyncio.to_thread(db_archive_history_chunk, cutoff)
+                archived += n
+                if n < ARCHIVE_CHUNK_SIZE: break
+                await asyncio.sleep(0.1)
+            if archived: print(f"DEBUG Compaction: Archived {archived} history rows older than {cutoff[:10]}")
+    except Exception as e:
+        print(f"ERROR Compaction: {str(e)}")
+
+async def compaction_loop():
+    while True:
+        # Only one worker per container compacts each round
+        if shared_cache.add("lease:compaction", os.getpid(), max(COMPACTION_INTERVAL - 5, 5)):
+            await compact_analytics()
+        await asyncio.sleep(COMPACTION_INTERVAL)
+
+@app.on_event("startup")
+async def start_compaction():
+    app.state.compaction_task = asyncio.create_task(compaction_loop())
+
+def db_rollup_series(granularity: str, since: str, metrics):
+    """{(bucket, metric, dim): n} for buckets >= since."""
+    if supabase:
+        res = supabase.table("rollups").select("bucket, metric, dim, n").eq("granularity", granularity).gte("bucket", since).in_("metric", list(metrics)).execute()
+        rows = [(r["bucket"], r["metric"], r["dim"], r["n"]) for r in res.data]
+    else:
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute(f"SELECT bucket, metric, dim, n FROM rollups WHERE granularity=? AND metric IN ({','.join('?' * len(metrics))}) AND bucket >= ?",
+                       (granularity, *metrics, since))
+        rows = cursor.fetchall(); conn.close()
+    return {(b, m, d): n for b, m, d, n in rows}
+
+def db_rollup_top(metric: str, limit: int, since: Optional[str] = None):
+    """Top dims by count: all-time from the 'all' bucket, or summed over daily buckets >= since."""
+    if since is None:
+        if supabase:
+            res = supabase.table("rollups").select("dim, n").eq("granularity", "all").eq("metric", metric).order("n", desc=True).limit(limit).execute()
+            return [(r["dim"], r["n"]) for r in res.data]
+        conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+        cursor.execute("SELECT dim, n FROM rollups WHERE granularity='all' AND metric=? AND bucket='all' ORDER BY n DESC LIMIT ?", (metric, limit))
+        rows = cursor.fetchall(); conn.close()
+        return rows
+    if supabase:
+        counts = Counter()
+        for (_, _, dim), n in db_rollup_series("day", since, [metric]).items(): counts[dim] += n
+        return counts.most_common(limit)
+    conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+    cursor.execute("SELECT dim, SUM(n) AS total FROM rollups WHERE granularity='day' AND metric=? AND bucket >= ? GROUP BY dim ORDER BY total DESC LIMIT ?", (metric, since, limit))
+    rows = cursor.fetchall(); conn.close()
+    return rows
+
+def build_analytics(days: int, top: int) -> dict:
+    now = datetime.now()
+    since_day = (now - timedelta(days=days - 1)).isoformat()[:10]
+    since_hour = (now - timedelta(hours=23)).isoformat()[:13]
+    daily = db_rollup_series("day", since_day, ("scans", "status", "active_users"))
+    hourly = db_rollup_series("hour", since_hour, ("scans", "active_users"))
+    totals = db_rollup_series("all", "all", ("scans", "active_users"))
+
+    def series(data, buckets, with_status):
+        out = []
+        for bucket in buckets:
+            entry = {"bucket": bucket, "scans": data.get((bucket, "scans", ""), 0), "active_users": data.get((bucket, "active_users", ""), 0)}
+            if with_status:
+                entry["status"] = {d: n for (b, m, d), n in data.items() if b == bucket and m == "status"}
+            out.append(entry)
+        return out
+
+    day_buckets = [(now - timedelta(days=i)).isoformat()[:10] for i in range(days - 1, -1, -1)]
+    hour_buckets = [(now - timedelta(hours=i)).isoformat()[:13] for i in range(23, -1, -1)]
+    pairs = lambda rows: [{"key": k, "count": n} for k, n in rows]
+    return {
+        "generated_at": now.isoformat(),
+        "totals": {"scans": totals.get(("all", "scans", ""), 0), "users": totals.get(("all", "active_users", ""), 0)},
+        "daily": series(daily, day_buckets, True),
+        "hourly": series(hourly, hour_buckets, False),
+        "top_barcodes": {"window": pairs(db_rollup_top("barcode", top, since_day)), "all_time": pairs(db_rollup_top("barcode", top))},
+        "top_additives": {"window": pairs(db_rollup_top("additive", top, since_day)), "all_time": pairs(db_rollup_top("additive", top))},
+    }
+
+@app.get("/admin/analytics", dependencies=[Depends(require_admin)])
+async def admin_analytics(days: int = 7, top: int = 10):
+    days = max(1, min(days, ANALYTICS_MAX_DAYS))
+    top = max(1, min(top, 100))
+    return await asyncio.to_thread(build_analytics, days, top)
+
+# Continuous Scan Session (WebSocket)
+# The client sends barcodes as they are decoded (a bare barcode string is a valid frame); the
+# server pushes the AnalysisResponse and then the alternatives. An open socket with a username
+# counts as presence, replacing the /ping heartbeat.
+SCAN_DEDUP_WINDOW = float(os.getenv("SCAN_DEDUP_WINDOW", 5))
+PRESENCE_INTERVAL = int(os.getenv("PRESENCE_INTERVAL", 60))
+
+@app.websocket("/ws/scan")
+async def scan_session(websocket: WebSocket):
+    await websocket.accept()
+    session = {"username": None, "settings": {}}
+    recent: Dict[str, float] = {}   # barcode -> last time it was accepted
+    analyzing: set = set()          # barcodes whose analysis frame has not been sent yet
+    tasks: set = set()
+    presence_task: Optional[asyncio.Task] = None
+    send_lock = asyncio.Lock()
+
+    async def send(message: dict):
+        async with send_lock:
+            try:
+                await websocket.send_json(message)
+            except Exception as e:
+                print(f"DEBUG WS: Could not push {message.get('type')}: {str(e)}")  # Client already gone
+
+    async def presence_loop(username: str):
+        while True:
+            await asyncio.to_thread(db_update_last_active, username)
+            await asyncio.sleep(PRESENCE_INTERVAL)
+
+    async def handle_scan(barcode: str):
+        cls = admission.classes["scan"]
+        if not await admission.acquire(cls):
+            await send({"type": "busy", "barcode": barcode, "retry_after": 1})
+            return
+        analyzing.add(barcode)
+        try:
+            request = AnalysisRequest(username=session["username"], barcode=barcode, settings=session["settings"])
+            analysis = await run_analysis(request)
+            await send({"type": "analysis", "barcode": barcode, "data": analysis.payload.content})
+        except HTTPException as e:
+            await send({"type": "error", "barcode": barcode, "detail": e.detail})
+            return
+        except Exception as e:
+            print(f"ERROR WS: Scan of {barcode} failed: {str(e)}")
+            traceback.print_exc()
+            await send({"type": "error", "barcode": barcode, "detail": "Error al analizar"})
+            return
+        finally:
+            analyzing.discard(barcode)
+            admission.release(cls)
+        if analysis.response.status == "ERROR":
+            # Not found: no alternatives to search, but the client is still waiting on them
+            await send({"type": "alternatives", "barcode": barcode, "data": []})
+            return
+
+        # The scan slot is free again; the alternatives search waits in its own, lower class
+        alt_cls = admission.classes["alternatives"]
+        if not await admission.acquire(alt_cls):
+            await send({"type": "busy", "barcode": barcode, "retry_after": 2, "stage": "alternatives"})
+            return
+        try:
+            alts = await get_alternatives_cached(barcode, analysis.response.categories, analysis.response.product_name)
+            await send({"type": "alternatives", "barcode": barcode, "data": jsonable_encoder(alts)})
+        except Exception as e:
+            print(f"WARNING WS: Alternatives for {barcode} failed: {str(e)}")
+            await send({"type": "error", "barcode": barcode, "stage": "alternatives", "detail": "Error al cargar sugerencias"})
+        finally:
+            admission.release(alt_cls)
+
+    try:
+        while True:
+            raw = (await websocket.receive_text()).strip()
+            message = json.loads(raw) if raw.startswith("{") else {"type": "scan", "barcode": raw}
+            kind = message.get("type")
+
+            if kind == "hello" or kind == "settings":
+                if isinstance(message.get("settings"), dict):
+                    session["settings"] = message["settings"]
+                if kind == "hello" and message.get("username") != session["username"]:
+                    session["username"] = message.get("username") or None
+                    if presence_task: presence_task.cancel()
+                    presence_task = asyncio.create_task(presence_loop(session["username"])) if session["username"] else None
+            elif kind == "scan" and message.get("barcode"):
+                barcode = str(message["barcode"]).strip()
+                now = time.monotonic()
+                if now - recent.get(barcode, 0) < SCAN_DEDUP_WINDOW:
+                    # Same code read again; tell the client whether its analysis is still coming
+                    await send({"type": "duplicate", "barcode": barcode, "pending": barcode in analyzing})
+                    continue
+                recent[barcode] = now
+                for code, seen in list(recent.items()):
+                    if now - seen >= SCAN_DEDUP_WINDOW: del recent[code]
+                task = asyncio.create_task(handle_scan(barcode))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    except (WebSocketDisconnect, json.JSONDecodeError) as e:
+        if isinstance(e, json.JSONDecodeError):
+            await websocket.close(code=1003)
+        print(f"DEBUG WS: Scan session closed ({session['username'] or 'anon'})")
+    finally:
+        if presence_task: presence_task.cancel()
+        for task in tasks: task.cancel()
 
 @app.get("/stats/{username}")
 async def get_stats(username: str):
@@ -867,41 +2434,68 @@ async def get_stats(username: str):
         rows = cursor.fetchall()
         conn.close()
     
-    if not rows:
+    archive = db_get_history_archive(username) or {}  # History compacted by the retention policy
+    if not rows and not archive.get("total"):
         return {"total": 0, "avg": 0, "safe": 0, "warning": 0, "danger": 0}
     
-    total = len(rows)
-    avg = sum(r[0] for r in rows) / total
-    safe = sum(1 for r in rows if r[1] == 'SAFE')
-    warning = sum(1 for r in rows if r[1] == 'WARNING')
-    danger = sum(1 for r in rows if r[1] == 'DANGER')
+    total = len(rows) + (archive.get("total") or 0)
+    avg = (sum(r[0] or 0 for r in rows) + (archive.get("score_sum") or 0)) / total
+    safe = sum(1 for r in rows if r[1] == 'SAFE') + (archive.get("safe") or 0)
+    warning = sum(1 for r in rows if r[1] == 'WARNING') + (archive.get("warning") or 0)
+    danger = sum(1 for r in rows if r[1] == 'DANGER') + (archive.get("danger") or 0)
     
     return {"total": total, "avg": int(avg), "safe": safe, "warning": warning, "danger": danger}
 
+@app.get("/additives/version")
+def get_additives_version():
+    catalog = get_catalog()
+    return {"version": catalog.version, "entries": len(catalog.details)}
+
+@app.get("/additives/search")
+def search_additives(http_request: Request, q: str = "", limit: int = 10):
+    """Ranked autocomplete over additive codes, names and synonyms."""
+    catalog = get_catalog()
+    limit = max(1, min(limit, 50))
+    hits = catalog.search_index.search(q, limit=limit)
+    return encoded_response(http_request, {
+        "query": q, "version": catalog.version,
+        "results": [{"code": d["code"], "name": d["name"], "safety": d["safety"], "score": s} for s, d in hits]
+    })
+
 @app.post("/lookup-additive")
-async def lookup_additive(request: dict):
+async def lookup_additive(request: dict, http_request: Request):
     q = request.get("query", "").lower().strip()
-    if not q: return {"error": "Query vacía"}
-    
-    # Check by code
-    code = q if q.startswith("e") else f"e{q}"
-    code_upper = code.upper()
-    detail = ADDITIVES_DB.get(code_upper) or ADDITIVES_DB.get(f"E-{q.upper()}")
+    if not q: return encoded_response(http_request, {"error": "Query vacía"})
     
-    # Check by name in DICT if not found by code
-    if not detail:
-        for k, v in ADDITIVES_DICT.items():
-            if q in k or q in v["name"].lower():
-                detail = v
-                break
-                
-    if not detail and re.search(r'\d+', q):
-        detail = get_fallback_detail(code_upper)
+    catalog = get_catalog()
+    index = catalog.search_index
+    code, is_code = index.normalize_query(q)
+    if is_code:
+        # Code forms ("102", "e 621", "E-102") resolve to curated entries; only an exact code hit counts
+        hits = index.search(q, limit=1, fuzzy=False)
+        detail = hits[0][1] if hits and hits[0][0] >= index.CODE_EXACT else catalog.fallback(code.upper())
+    else:
+        # Check by name (best-ranked match, tolerant to accents and typos)
+        hits = index.search(q, limit=1)
+        detail = hits[0][1] if hits else None
+        if not detail and re.search(r'\d+', q):
+            detail = catalog.fallback(f"E{q}".upper() if not q.startswith("e") else q.upper())
         
     if not detail:
-        return {"error": "Aditivo no encontrado"}
-    return detail
-
+        return encoded_response(http_request, {"error": "Aditivo no encontrado"})
+    return encoded_response(http_request, payload=catalog.payload(detail))
+
+@app.get("/metrics")
+def get_metrics():
+    """Live per-worker counters: admission queue depths, cache hit ratios, job queue, upstream latency."""
+    return {
+        "pid": os.getpid(),
+        "admission": admission.snapshot(),
+        "cache": shared_cache.stats,
+        "jobs": {"queued": job_queue.queue.qsize() if job_queue.queue else 0, "running": len(job_queue.running)},
+        "off": {"p95": round(off_latency.p95(), 3), "timeout": round(off_latency.timeout(), 3), "samples": len(off_latency.samples)},
+        "catalog_version": get_catalog().version,
+    }
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -0,0 +1,97 @@
+"""Additive search ranking and /lookup-additive resolution, over a small fixed catalog."""
+import os
+import sys
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "")
+os.environ.setdefault("SUPABASE_KEY", "")
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(), "cache.db"))
+
+import main  # noqa: E402
+
+
+def entry(code, name, aliases=(), codes=None):
+    return {"aliases": list(aliases), "codes": [code] if codes is None else codes,
+            "detail": {"code": code, "name": name, "safety": "warning"}}
+
+
+CATALOG = {
+    "version": "test",
+    "additives": [
+        # "aroma" is an alias of the generic entry and the code of the artificial one
+        entry("AROMA", "Aromas / Aromatizantes", ["aroma", "aromatizante"], codes=[]),
+        entry("AROMA", "Aroma Artificial", ["aroma artificial"]),
+        entry("E102", "Tartrazina", ["tartrazina"]),
+        entry("E621", "Glutamato Monosódico", ["glutamato monosodico", "msg"]),
+        entry("E420", "Sorbitoles", ["sorbitoles"]),
+        entry("E420i", "Sorbitol", ["sorbitol"]),
+        entry("E433", "Polisorbato 80", ["polisorbato 80"]),
+    ],
+    "fallback": {
+        "ranges": [{"min": 100, "max": 199, "detail": {"code": "", "name": "Colorante {code}", "safety": "warning"}}],
+        "default": {"code": "", "name": "Aditivo {code}", "safety": "warning"},
+        "unknown": {"code": "", "name": "Aditivo desconocido", "safety": "warning"},
+    },
+}
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    catalog = main.AdditiveCatalog(CATALOG, "0" * 8)
+    monkeypatch.setattr(main, "get_catalog", lambda: catalog)
+    return catalog
+
+
+def names(catalog, query, **kwargs):
+    return [d["name"] for _, d in catalog.search_index.search(query, **kwargs)]
+
+
+def lookup(query):
+    return TestClient(main.app).post("/lookup-additive", json={"query": query}).json()
+
+
+def test_exact_alias_beats_code_match(catalog):
+    hits = catalog.search_index.search("aroma")
+    assert [d["name"] for _, d in hits[:2]] == ["Aromas / Aromatizantes", "Aroma Artificial"]
+    assert hits[0][0] == catalog.search_index.EXACT
+    assert hits[1][0] == catalog.search_index.CODE_EXACT
+    assert lookup("aroma")["name"] == "Aromas / Aromatizantes"
+
+
+@pytest.mark.parametrize("query", ["E102", "e102", "E-102", "e 102", "102"])
+def test_code_forms_resolve_to_the_curated_entry(catalog, query):
+    assert lookup(query)["name"] == "Tartrazina"
+
+
+def test_code_lookup_is_case_insensitive_and_falls_back_by_range(catalog):
+    assert lookup("e420i")["name"] == "Sorbitol"
+    assert lookup("e 621")["name"] == "Glutamato Monosódico"
+    assert lookup("E150d")["name"] == "Colorante E150D"  # Not curated: range template, never a fuzzy neighbour
+
+
+@pytest.mark.parametrize("query", ["tartrazína", "TARTRAZINA", "tartrazna", "tartrazinq"])
+def test_accents_case_and_typos(catalog, query):
+    assert names(catalog, query, limit=1) == ["Tartrazina"]
+    assert lookup(query)["name"] == "Tartrazina"
+
+
+def test_prefix_ordering(catalog):
+    hits = catalog.search_index.search("sorb")
+    # Shorter completions first, then entries where the query is only inside a word
+    assert [d["name"] for _, d in hits] == ["Sorbitol", "Sorbitoles", "Polisorbato 80"]
+    assert [s for s, _ in hits] == sorted((s for s, _ in hits), reverse=True)
+    assert hits[-1][0] == catalog.search_index.SUBSTRING
+
+
+def test_multi_word_prefixes_match_in_any_order(catalog):
+    assert names(catalog, "monosod glut") == ["Glutamato Monosódico"]
+
+
+def test_no_hit_returns_not_found(catalog):
+    assert names(catalog, "xyz") == []
+    assert lookup("xyz") == {"error": "Aditivo no encontrado"}
+    assert lookup("   ") == {"error": "Query vacía"}
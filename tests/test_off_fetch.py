@@ -0,0 +1,81 @@
+"""OpenFoodFacts fetch timing: adaptive timeouts must recover from a slowdown, and the
+whole fetch (retries and hedges included) must finish within OFF_FETCH_DEADLINE.
+
+Timings are scaled down ~10x so the suite runs in a few seconds."""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "")
+os.environ.setdefault("SUPABASE_KEY", "")
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(), "cache.db"))
+
+import main  # noqa: E402
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, barcode):
+        self.barcode = barcode
+
+    def json(self):
+        return {"status": 1, "product": {"code": self.barcode}}
+
+
+def fake_client(delay: float):
+    """httpx.AsyncClient stand-in whose requests take `delay` seconds on every host."""
+    class FakeClient:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def get(self, url, headers=None, timeout=None):
+            await asyncio.sleep(delay)
+            return FakeResponse(url.rsplit("/", 1)[-1].split(".")[0])
+
+    return FakeClient
+
+
+@pytest.fixture
+def scaled(monkeypatch):
+    monkeypatch.setattr(main, "OFF_MIN_TIMEOUT", 0.2)
+    monkeypatch.setattr(main, "OFF_MAX_TIMEOUT", 0.8)
+    monkeypatch.setattr(main, "OFF_MIN_HEDGE_DELAY", 0.025)
+    monkeypatch.setattr(main, "OFF_FETCH_DEADLINE", 1.2)
+    monkeypatch.setattr(main, "OFF_MIRROR_HOST", "https://mirror.invalid")
+    tracker = main.LatencyTracker()
+    monkeypatch.setattr(main, "off_latency", tracker)
+    return tracker
+
+
+def test_recovers_when_upstream_slows_past_the_learned_timeout(scaled, monkeypatch):
+    # A fast period pins p95 at 30 ms, so the timeout sits at its 200 ms floor...
+    for _ in range(200):
+        scaled.observe(0.03)
+    assert scaled.timeout() == pytest.approx(0.2)
+
+    # ...then every request starts taking 300 ms.
+    monkeypatch.setattr(main.httpx, "AsyncClient", fake_client(0.3))
+    data = asyncio.run(main._fetch_off_product_remote("123"))
+
+    assert data["product"]["code"] == "123"
+    assert scaled.consecutive_timeouts == 0
+
+
+def test_fetch_respects_deadline_when_every_host_hangs(scaled, monkeypatch):
+    monkeypatch.setattr(main.httpx, "AsyncClient", fake_client(60))
+    start = time.monotonic()
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main._fetch_off_product_remote("123"))
+
+    assert exc.value.status_code == 504
+    assert time.monotonic() - start <= main.OFF_FETCH_DEADLINE + 0.1
@@ -0,0 +1,112 @@
+"""Analytics rollups must keep matching raw history: across the background backfill of
+pre-existing rows, live scans, re-scoring, and archiving by the retention policy."""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "")
+os.environ.setdefault("SUPABASE_KEY", "")
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(tempfile.mkdtemp(), "cache.db"))
+
+import main  # noqa: E402
+
+STATUSES = ("SAFE", "WARNING", "DANGER")
+USERS = [f"user{i}" for i in range(6)]
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """A history table written before rollups existed: 300 scans over the last 20 days."""
+    path = str(tmp_path / "foodguard.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT, settings TEXT)")
+    conn.execute("CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, barcode TEXT, product_name TEXT, "
+                 "status TEXT, score INTEGER, timestamp DATETIME)")
+    rng, now = random.Random(7), datetime.now()
+    conn.executemany(
+        "INSERT INTO history (username, barcode, product_name, status, score, timestamp) VALUES (?, ?, 'P', ?, ?, ?)",
+        [(rng.choice(USERS), f"84{rng.randint(0, 20):05d}", rng.choice(STATUSES), rng.randint(0, 100),
+          (now - timedelta(hours=rng.randint(0, 20 * 24))).isoformat()) for _ in range(300)])
+    conn.commit(); conn.close()
+
+    monkeypatch.setattr(main, "DB_PATH", path)
+    monkeypatch.setattr(main, "ROLLUP_BACKFILL_CHUNK", 64)
+    main.init_db()
+    return path
+
+
+def rescore(path, row_id, status):
+    conn = sqlite3.connect(path)
+    old_status, timestamp = conn.execute("SELECT status, timestamp FROM history WHERE id=?", (row_id,)).fetchone()
+    conn.close()
+    new_status = status if status != old_status else next(s for s in STATUSES if s != old_status)
+    main.db_update_scores([(row_id, 1, new_status, old_status, timestamp)])
+
+
+def rollups(path, granularity, since=""):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT bucket, metric, dim, n FROM rollups WHERE granularity=? AND metric IN ('scans', 'status', 'barcode', 'active_users') "
+                        "AND bucket >= ? AND n != 0", (granularity, since)).fetchall()
+    conn.close()
+    return {(b, m, d): n for b, m, d, n in rows}
+
+
+def recount(path, granularity, since=""):
+    size = dict(main.ROLLUP_GRANULARITIES)[granularity]
+    bucket = f"substr(timestamp, 1, {size})" if size else "'all'"
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        f"SELECT b, m, d, n FROM (SELECT {bucket} AS b, 'scans' AS m, '' AS d, COUNT(*) AS n FROM history GROUP BY 1 "
+        f"UNION ALL SELECT {bucket}, 'status', status, COUNT(*) FROM history GROUP BY 1, 3 "
+        f"UNION ALL SELECT {bucket}, 'barcode', barcode, COUNT(*) FROM history GROUP BY 1, 3 "
+        f"UNION ALL SELECT {bucket}, 'active_users', '', COUNT(DISTINCT username) FROM history GROUP BY 1) WHERE b >= ?", (since,)).fetchall()
+    conn.close()
+    return {(b, m, d): n for b, m, d, n in rows}
+
+
+def stats_from_history(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT username, score, status FROM history").fetchall()
+    conn.close()
+    stats = {}
+    for username in USERS:
+        mine = [(score, status) for u, score, status in rows if u == username]
+        stats[username] = {"total": len(mine), "avg": int(sum(s for s, _ in mine) / len(mine)) if mine else 0,
+                           **{s.lower(): sum(1 for _, st in mine if st == s) for s in STATUSES}}
+    return stats
+
+
+def test_rollups_match_history_across_backfill_rescore_and_archiving(db, monkeypatch):
+    # Live scans and re-scores land while the backfill is still pending
+    for username in USERS[:3]:
+        main.db_save_history(username, "8400001", "P", "SAFE", 80)
+    rescore(db, 10, "DANGER")   # Not backfilled yet: the backfill counts its new status
+    rescore(db, 302, "DANGER")  # Counted live: its status moves now
+
+    asyncio.run(main.backfill_rollups())
+    rescore(db, 20, "WARNING")  # Backfilled: its status moves now
+
+    hour_cutoff = (datetime.now() - timedelta(days=main.ROLLUP_HOURLY_RETENTION_DAYS)).isoformat()[:13]
+    for granularity, since in (("all", ""), ("day", ""), ("hour", hour_cutoff)):
+        assert rollups(db, granularity, since) == recount(db, granularity, since), granularity
+
+    # Retention folds old rows into history_archive; rollups and /stats must not change
+    expected_all, expected_stats = recount(db, "all"), stats_from_history(db)
+    monkeypatch.setattr(main, "HISTORY_RETENTION_DAYS", 10)
+    monkeypatch.setattr(main, "ARCHIVE_CHUNK_SIZE", 50)
+    asyncio.run(main.compact_analytics())
+
+    conn = sqlite3.connect(db)
+    remaining = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+    conn.close()
+    assert 0 < remaining < 303
+    assert rollups(db, "all") == expected_all
+    for username in USERS:
+        assert asyncio.run(main.get_stats(username)) == expected_stats[username], username